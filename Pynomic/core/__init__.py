@@ -13,6 +13,7 @@
 
 from .core import Pynomicproject
 from .plot import Pynomicplotter
+from .storage import StorageProfile
 
 
-__all__ = ["Pynomicproject", "Pynomicplotter"]
+__all__ = ["Pynomicproject", "Pynomicplotter", "StorageProfile"]
@@ -25,6 +25,17 @@ from scipy.optimize import root
 from statsmodels.nonparametric.smoothers_lowess import lowess
 from scipy.interpolate import interp1d
 import json
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from functools import partial
+from itertools import islice
+import threading
+from . import senescence
+from .storage import copy_with_profile, get_profile
 
 # =============================================================================
 # CLASSES
@@ -42,14 +53,55 @@ class Pynomicproject:
 
     ldata :Pandas Dataframe
         contains all the procesed data.
+
+    ldata_loader :callable
+        function that returns ldata, called on the first access when ldata
+        is None.
+
+    raw_loader :callable
+        function that opens raw_data, called on the first access when
+        raw_data is None.
+
+    plots :list
+        ids of the plots of the project. None uses all the plots stored
+        in raw_data.
+
+    partial :bool
+        True when only a part of the saved project was read.
     """
 
-    raw_data: zarr.Group
-    ldata: pd.DataFrame
+    _raw_data: zarr.Group
+    _ldata: pd.DataFrame
     n_dates: int
     dates: list
     n_bands: int
     bands_name: list
+    _ldata_loader: object = attrs.field(default=None, repr=False)
+    _raw_loader: object = attrs.field(default=None, repr=False)
+    _plots: list = None
+    _partial: bool = False
+
+    @property
+    def raw_data(self):
+        """zarr.Group with the bands of each plot and date."""
+        if self._raw_data is None and self._raw_loader is not None:
+            self._raw_data = self._raw_loader()
+        return self._raw_data
+
+    @raw_data.setter
+    def raw_data(self, value):
+        self._raw_data = value
+
+    @property
+    def ldata(self):
+        """Processed data of each plot and date as a DataFrame."""
+        if self._ldata is None and self._ldata_loader is not None:
+            self._ldata = self._ldata_loader()
+        return self._ldata
+
+    @ldata.setter
+    def ldata(self, value):
+        self._ldata = value
 
     def __getitem__(self, k: str):
         """Allow attribute access using dictionary-like syntax.
@@ -74,6 +126,244 @@ class Pynomicproject:
         except AttributeError:
             raise KeyError(k)
 
+    def plot_ids(self, date):
+        """Returns the ids of the plots stored for a date.
+
+        Parameters
+        ----------
+        date :str
+            flight date.
+
+        Returns
+        -------
+            list with the plots ids.
+        """
+        date_group = self.raw_data["dates"][date]
+        if date_group.attrs.get("layout") == "ragged":
+            ids = list(date_group.attrs["plots"])
+        else:
+            ids = list(date_group.group_keys())
+        if self._plots is not None:
+            ids = [p for p in ids if p in self._plots]
+        return ids
+
+    def _date_reader(self, date, bands=None):
+        """Returns a function that reads the bands of a plot in a date.
+
+        The group handles of the date, and the index of the ragged layout,
+        are resolved once and shared by all the reads. The chunks of the
+        ragged band arrays are decoded once and the plots are sliced from
+        them in memory.
+
+        Parameters
+        ----------
+        date :str
+            flight date.
+        bands :list
+            bands to read, by default all of them.
+
+        Returns
+        -------
+            function that takes a plot id and returns the dict with the
+            array of each band.
+        """
+        bands = self.bands_name if bands is None else bands
+        date_group = self.raw_data["dates"][date]
+        if date_group.attrs.get("layout") == "ragged":
+            positions = {p: i for i, p in enumerate(date_group.attrs["plots"])}
+            index = date_group["index"][:]
+            band_readers = [_chunk_reader(date_group[band]) for band in bands]
+
+            def _read(plot):
+                offset, height, width = index[positions[plot]]
+                end = offset + height * width
+                return {
+                    band: read(offset, end).reshape(height, width)
+                    for band, read in zip(bands, band_readers)
+                }
+
+        else:
+
+            def _read(plot):
+                plot_group = date_group[plot]
+                return {band: plot_group[band][:] for band in bands}
+
+        return _read
+
+    def plot_arrays(self, date, plot, bands=None):
+        """Returns the bands arrays of a plot in a date.
+
+        Works with both layouts of the raw data, a group per plot or the
+        ragged layout with one concatenated array per band.
+
+        Parameters
+        ----------
+        date :str
+            flight date.
+        plot :str
+            id of the plot.
+        bands :list
+            bands to read, by default all of them.
+
+        Returns
+        -------
+            dict with the array of each band.
+        """
+        return self._date_reader(date, bands)(plot)
+
+    def iter_plot_arrays(self, dates=None, plots=None, bands=None, prefetch=4):
+        """Iterates over the bands arrays of each plot and date.
+
+        The arrays are read and decompressed ahead in background threads
+        while the caller processes the previous ones.
+
+        Parameters
+        ----------
+        dates :list
+            dates to read, by default all the project dates.
+        plots :list
+            ids of the plots to read, in this order, by default all of
+            them. They are looked up directly, without listing the plots
+            of each date.
+        bands :list
+            bands to read, by default all of them.
+        prefetch :int
+            number of plots read ahead. 0 reads them in the caller thread.
+
+        Yields
+        ------
+            tuple with the date, the plot id and the dict with the array
+            of each band.
+
+        Raises
+        ------
+        KeyError
+            If a plot of plots is not stored for a date.
+        """
+        dates = self.dates if dates is None else dates
+        selected = None if self._plots is None else set(self._plots)
+
+        def _tasks():
+            for date in dates:
+                reader = self._date_reader(date, bands)
+                if plots is None:
+                    date_plots = self.plot_ids(date)
+                else:
+                    date_plots = plots
+                    for plot in plots:
+                        if selected is not None and plot not in selected:
+                            raise KeyError(plot)
+                for plot in date_plots:
+                    yield date, plot, reader
+
+        if not prefetch:
+            for date, plot, reader in _tasks():
+                yield date, plot, reader(plot)
+            return
+
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque()
+            for date, plot, reader in _tasks():
+                pending.append((date, plot, executor.submit(reader, plot)))
+                if len(pending) > prefetch:
+                    date, plot, future = pending.popleft()
+                    yield date, plot, future.result()
+            while pending:
+                date, plot, future = pending.popleft()
+                yield date, plot, future.result()
+
+    def map_plot_arrays(
+        self,
+        function,
+        dates=None,
+        plots=None,
+        bands=None,
+        n_jobs=None,
+        executor=None,
+        backend="threads",
+        chunk_size=64,
+        batched=False,
+    ):
+        """Applies a function to the bands arrays of each plot and date.
+
+        Parameters
+        ----------
+        function :function
+            function that takes the dict with the array of each band. With
+            the "processes" backend it must be defined at module level.
+        dates :list
+            dates to process, by default all the project dates.
+        plots :list
+            ids of the plots to process, by default all of them.
+        bands :list
+            bands passed to the function, by default all of them.
+        n_jobs :int
+            number of workers. None or 1 runs in the caller thread.
+        executor :concurrent.futures.Executor
+            executor to use instead of creating one.
+        backend :str
+            "threads" for NumPy or OpenCV code that releases the GIL,
+            "processes" for pure Python functions.
+        chunk_size :int
+            number of plots sent to a worker at a time.
+        batched :bool
+            the function takes the list with the dicts of a chunk of plots
+            and returns the list with their values.
+
+        Yields
+        ------
+            tuple with the date, the plot id and the value returned by the
+            function, in the project order.
+        """
+        items = self.iter_plot_arrays(dates=dates, plots=plots, bands=bands)
+        pool = None
+        if executor is None and n_jobs is not None and n_jobs > 1:
+            if backend == "threads":
+                pool = ThreadPoolExecutor(max_workers=n_jobs)
+            elif backend == "processes":
+                pool = ProcessPoolExecutor(max_workers=n_jobs)
+            else:
+                raise ValueError(
+                    f"backend must be 'threads' or 'processes', "
+                    f"not {backend!r}"
+                )
+            executor = pool
+
+        if not batched:
+            function = partial(_apply_chunk, function)
+
+        if executor is None:
+            while True:
+                chunk = list(islice(items, chunk_size))
+                if not chunk:
+                    return
+                values = function([a for _, _, a in chunk])
+                for (date, plot, _), value in zip(chunk, values):
+                    yield date, plot, value
+
+        # A bounded number of chunks is in flight, so the arrays of the
+        # whole project are never held in memory at once.
+        max_pending = 2 * (n_jobs or os.cpu_count() or 1)
+        try:
+            pending = deque()
+            while True:
+                chunk = list(islice(items, chunk_size))
+                if chunk:
+                    keys = [(date, plot) for date, plot, _ in chunk]
+                    future = executor.submit(
+                        function, [a for _, _, a in chunk]
+                    )
+                    pending.append((keys, future))
+                if not pending:
+                    break
+                if len(pending) >= max_pending or not chunk:
+                    keys, future = pending.popleft()
+                    for (date, plot), value in zip(keys, future.result()):
+                        yield date, plot, value
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
     def RGB_VI(self, Red, Blue, Green):
         """Calculates RGB Vegetation index.
 
@@ -190,7 +480,16 @@ class Pynomicproject:
 
         return
 
-    def Calcualte_TI_GLCM(self, distances: list, angles: list):
+    def Calcualte_TI_GLCM(
+        self,
+        distances: list,
+        angles: list,
+        levels: int = 256,
+        n_jobs=None,
+        executor=None,
+        backend="processes",
+        chunk_size=16,
+    ):
         """Calculates texturial indices from bands.
 
         be aweare the O = (n_dist * n_bands)^n_angles.
@@ -202,112 +501,45 @@ class Pynomicproject:
             list of distances to work usaly 2 or 3 .
         algles:lsit
             list of angles to work.
+        levels:int
+            gray levels of the matrix. Values lower than 256, like 32 or
+            64, quantize the bands and make the matrices much smaller.
+        n_jobs:int
+            number of workers. The plots and dates are split among them
+            and the features merged into ldata at the end.
+        executor:concurrent.futures.Executor
+            executor to use instead of creating one.
+        backend:str
+            "processes" or "threads". See map_plot_arrays.
+        chunk_size:int
+            number of plots sent to a worker at a time.
 
         Returns
         -------
             geodataframe.
         """
-
-        def _calculate_GLCM(df, angles, distances, bands):
-            features_names = []
-            glcm_values = []
-            for angl in angles:
-                for dist in distances:
-                    for b in bands:
-                        gray = df[b][:].copy()
-                        if not np.issubdtype(gray.dtype, np.uint8):
-                            gray *= 255 / np.round(gray, 6).max()
-                            gray = np.uint8(np.round(gray, 0).astype(int))
-                        glcm = graycomatrix(
-                            gray,
-                            distances=[dist],
-                            angles=[angl],
-                            levels=256,
-                            symmetric=True,
-                            normed=True,
-                        )
-                        features_names.append(
-                            b
-                            + "_"
-                            + str(dist)
-                            + "_"
-                            + str(angl)
-                            + "_"
-                            + "cont"
-                        )
-                        glcm_values.append(
-                            round(graycoprops(glcm, "contrast")[0][0], 4)
-                        )
-                        features_names.append(
-                            b
-                            + "_"
-                            + str(dist)
-                            + "_"
-                            + str(angl)
-                            + "_"
-                            + "disst"
-                        )
-                        glcm_values.append(
-                            round(graycoprops(glcm, "dissimilarity")[0][0], 4)
-                        )
-                        features_names.append(
-                            b
-                            + "_"
-                            + str(dist)
-                            + "_"
-                            + str(angl)
-                            + "_"
-                            + "homog"
-                        )
-                        glcm_values.append(
-                            round(graycoprops(glcm, "homogeneity")[0][0], 4)
-                        )
-                        features_names.append(
-                            b
-                            + "_"
-                            + str(dist)
-                            + "_"
-                            + str(angl)
-                            + "_"
-                            + "energy"
-                        )
-                        glcm_values.append(
-                            round(graycoprops(glcm, "energy")[0][0], 4)
-                        )
-                        features_names.append(
-                            b
-                            + "_"
-                            + str(dist)
-                            + "_"
-                            + str(angl)
-                            + "_"
-                            + "corr"
-                        )
-                        glcm_values.append(
-                            round(graycoprops(glcm, "correlation")[0][0], 4)
-                        )
-            return glcm_values, features_names
-
+        glcm = partial(
+            _glcm_features,
+            distances=distances,
+            angles=angles,
+            bands=self.bands_name,
+            levels=levels,
+        )
         values_list = []
-        for flight_date in self.dates:
-            for plot in self.raw_data["dates"][flight_date].group_keys():
-                bands_names = []
-                bands_arr = []
-                for band in self.bands_name:
-                    bands_names.append(band)
-                    bands_arr.append(
-                        self.raw_data["dates"][flight_date][plot][band][:]
-                    )
-                values, features_names = _calculate_GLCM(
-                    df=dict(zip(bands_names, bands_arr)),
-                    distances=distances,
-                    angles=angles,
-                    bands=self.bands_name,
-                )
-                values.insert(0, plot)
-                values.insert(1, flight_date)
-                values_list.append(values)
+        for flight_date, plot, values in self.map_plot_arrays(
+            glcm,
+            n_jobs=n_jobs,
+            executor=executor,
+            backend=backend,
+            chunk_size=chunk_size,
+        ):
+            values.insert(0, plot)
+            values.insert(1, flight_date)
+            values_list.append(values)
 
+        features_names = _glcm_feature_names(
+            self.bands_name, distances, angles
+        )
         features_names.insert(0, "id")
         features_names.insert(1, "date")
 
@@ -325,6 +557,10 @@ class Pynomicproject:
         min_val=30,
         max_val=75,
         to_data=False,
+        n_jobs=None,
+        executor=None,
+        batch_size=256,
+        cache=False,
     ):
         """Extracts the green and non-green pixels from each image HSL.
 
@@ -342,99 +578,60 @@ class Pynomicproject:
             in HUE range.
         max_val:int
             in HUE range
+        n_jobs:int
+            number of threads that process the batches.
+        executor:concurrent.futures.Executor
+            executor to use instead of creating one.
+        batch_size:int
+            number of plots converted to HSV together.
+        cache:bool
+            count the pixels from the hue histograms of the raw data
+            cache, see hue_histograms. Once cached, the plot arrays are
+            not read again.
 
         Returns
         -------
             geodataframe.
         """
+        if cache:
+            hists = self.hue_histograms(
+                Red,
+                Blue,
+                Green,
+                image_shape,
+                n_jobs=n_jobs,
+                executor=executor,
+                batch_size=batch_size,
+            )
+            tidf = _sweep_hue_ranges(hists, [(min_val, max_val)]).drop(
+                columns=["min_val", "max_val"]
+            )
+            if to_data:
+                self.ldata = self.ldata.merge(tidf, on=["id", "date"])
+                return self.ldata
+            return tidf
 
-        def _calculate_grpx(
-            dicmtx,
-            red: str,
-            green: str,
-            blue: str,
-            min_val: int,
-            max_val: int,
-            im_shp=image_shape,
-        ):
-
-            if len(im_shp) < 4:
-                red1 = dicmtx[red][:]
-                red1 = cv2.normalize(
-                    red1, None, 255, 0, cv2.NORM_MINMAX, cv2.CV_8U
-                )
-                green1 = dicmtx[green][:]
-                green1 = cv2.normalize(
-                    green1, None, 255, 0, cv2.NORM_MINMAX, cv2.CV_8U
-                )
-                blue1 = dicmtx[blue][:]
-                blue1 = cv2.normalize(
-                    blue1, None, 255, 0, cv2.NORM_MINMAX, cv2.CV_8U
-                )
-            else:
-                red1 = dicmtx[red][
-                    im_shp[0] : im_shp[1], im_shp[2] : im_shp[3]
-                ]
-                red1 = cv2.normalize(
-                    red1, None, 255, 0, cv2.NORM_MINMAX, cv2.CV_8U
-                )
-                green1 = dicmtx[green][
-                    im_shp[0] : im_shp[1], im_shp[2] : im_shp[3]
-                ]
-                green1 = cv2.normalize(
-                    green1, None, 255, 0, cv2.NORM_MINMAX, cv2.CV_8U
-                )
-                blue1 = dicmtx[blue][
-                    im_shp[0] : im_shp[1], im_shp[2] : im_shp[3]
-                ]
-                blue1 = cv2.normalize(
-                    blue1, None, 255, 0, cv2.NORM_MINMAX, cv2.CV_8U
-                )
-
-            img = np.dstack([red1, green1, blue1])
-            hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
-            mask = cv2.inRange(hsv, (min_val, 25, 25), (max_val, 255, 255))
-
-            unique, counts = np.unique(mask, return_counts=True)
-            unique = unique.astype(int).tolist()
-            counts = counts.astype(int).tolist()
-            ab = dict(zip(unique, counts))
-            if len(unique) > 1:
-                val255 = mask == 255
-                val255 = int(val255.sum())
-                val0 = mask == 0
-                val0 = int(val0.sum())
-                por = val255 / (mask.shape[0] * mask.shape[1])
-                return [np.round(por, 2), val255, val0]
-            else:
-                if 0 in unique:
-                    nongr = ab.get(0)
-                    return [0, 0, nongr]
-                if 255 in unique:
-                    gp = ab.get(255)
-                    return [1, gp, 0]
-
+        green_pixels = partial(
+            _green_pixels_batch,
+            red=Red,
+            green=Green,
+            blue=Blue,
+            image_shape=image_shape,
+            min_val=min_val,
+            max_val=max_val,
+        )
         values_list = []
-        for flight_date in self.dates:
-            for plot in self.raw_data["dates"][flight_date].group_keys():
-                bands_names = []
-                bands_arr = []
-                for band in self.bands_name:
-                    bands_names.append(band)
-                    bands_arr.append(
-                        self.raw_data["dates"][flight_date][plot][band][:]
-                    )
-                values = _calculate_grpx(
-                    dicmtx=dict(zip(bands_names, bands_arr)),
-                    red=Red,
-                    green=Green,
-                    blue=Blue,
-                    min_val=min_val,
-                    max_val=max_val,
-                )
-                values.insert(0, plot)
-                values.insert(1, flight_date)
-                values_list.append(values)
+        for flight_date, plot, values in self.map_plot_arrays(
+            green_pixels,
+            bands=[Red, Green, Blue],
+            n_jobs=n_jobs,
+            executor=executor,
+            chunk_size=batch_size,
+            batched=True,
+        ):
+            values.insert(0, plot)
+            values.insert(1, flight_date)
+            values_list.append(values)
 
         features_names = [
             "id",
@@ -453,8 +650,207 @@ class Pynomicproject:
         else:
             return tidf
 
+    def _cache_root(self):
+        """Opens raw_data on its underlying store to read and write caches.
+
+        Projects opened with consolidated metadata do not see the nodes
+        added after the consolidation, the underlying store does.
+        """
+        return zarr.open_group(
+            self.raw_data.chunk_store, path=self.raw_data.path, mode="a"
+        )
+
+    def hue_histograms(
+        self,
+        Red: str,
+        Blue: str,
+        Green: str,
+        image_shape: tuple,
+        n_jobs=None,
+        executor=None,
+        batch_size=256,
+        cache=True,
+    ):
+        """Calculates the hue histogram of each plot and date.
+
+        The histograms are stored in raw_data under "cache", so later
+        calls only read the plots that are not cached yet, or whose date
+        was written again since then.
+
+        Parameters
+        ----------
+        Red:str
+            name of the column that contains the red band.
+        Blue:str
+            name of the column that contains the blue band.
+        Green:str
+            name of the column that contains the green band.
+        image_shape:tuple
+            (top, bottom, left, right) indicates the area
+        n_jobs:int
+            number of threads that process the batches.
+        executor:concurrent.futures.Executor
+            executor to use instead of creating one.
+        batch_size:int
+            number of plots converted to HSV together.
+        cache:bool
+            read and store the histograms in the raw data cache.
+
+        Returns
+        -------
+            DataFrame indexed by date and id with the count of pixels of
+            each hue, from 0 to 179, with saturation and value of at least
+            25, and the number of pixels of the plot in n_px.
+        """
+        hue_hist = partial(
+            _hue_histograms_batch,
+            red=Red,
+            green=Green,
+            blue=Blue,
+            image_shape=image_shape,
+        )
+        date_hists = {}
+        cached = {}
+        if cache:
+            root = self._cache_root()
+            key = "_".join([Red, Green, Blue, *map(str, image_shape)])
+            cache_group = root.require_group("cache/hue_hist/" + key)
+            revisions = {
+                d: root["dates"][d].attrs.get("revision") for d in self.dates
+            }
+            cached = {
+                d: _cached_hists(cache_group, d, revisions[d])
+                for d in self.dates
+            }
+
+        # Only the plots without a valid cached histogram are read.
+        date_plots = {d: self.plot_ids(d) for d in self.dates}
+        todo = {}
+        for flight_date, plots in date_plots.items():
+            date_cache = cached.get(flight_date, {})
+            date_hists[flight_date] = {
+                p: date_cache[p] for p in plots if p in date_cache
+            }
+            missing = [p for p in plots if p not in date_cache]
+            if missing:
+                todo[flight_date] = None if not date_cache else missing
+
+        pool = None
+        if executor is None and n_jobs is not None and n_jobs > 1:
+            pool = executor = ThreadPoolExecutor(max_workers=n_jobs)
+        try:
+            for flight_date, plots in todo.items():
+                for _, plot, hist in self.map_plot_arrays(
+                    hue_hist,
+                    dates=[flight_date],
+                    plots=plots,
+                    bands=[Red, Green, Blue],
+                    n_jobs=n_jobs,
+                    executor=executor,
+                    chunk_size=batch_size,
+                    batched=True,
+                ):
+                    date_hists[flight_date][plot] = hist
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        if cache:
+            for flight_date in todo:
+                # The histograms of the other plots, like those left out
+                # by an ids selection, are kept.
+                hists = {
+                    **cached[flight_date],
+                    **date_hists[flight_date],
+                }
+                arr = cache_group.array(
+                    flight_date,
+                    np.array(list(hists.values()), dtype=np.int64).reshape(
+                        -1, _N_HUES + 1
+                    ),
+                    overwrite=True,
+                )
+                arr.attrs.update(
+                    plots=list(hists), revision=revisions[flight_date]
+                )
+
+        index = [
+            (flight_date, plot)
+            for flight_date, plots in date_plots.items()
+            for plot in plots
+        ]
+        return pd.DataFrame(
+            np.array([date_hists[d][p] for d, p in index]).reshape(
+                -1, _N_HUES + 1
+            ),
+            index=pd.MultiIndex.from_tuples(index, names=["date", "id"]),
+            columns=[*range(_N_HUES), "n_px"],
+        )
+
+    def green_pixels_sweep(
+        self,
+        Red: str,
+        Blue: str,
+        Green: str,
+        image_shape: tuple,
+        hue_ranges: list,
+        n_jobs=None,
+        executor=None,
+        batch_size=256,
+        cache=True,
+    ):
+        """Green pixels of each plot for several hue ranges in one pass.
+
+        The plots are read once to calculate their hue histograms, and the
+        green pixels of every range are counted from them.
+
+        Parameters
+        ----------
+        Red:str
+            name of the column that contains the red band.
+        Blue:str
+            name of the column that contains the blue band.
+        Green:str
+            name of the column that contains the green band.
+        image_shape:tuple
+            (top, bottom, left, right) indicates the area
+        hue_ranges:list
+            list of (min_val, max_val) hue ranges.
+        n_jobs:int
+            number of threads that process the batches.
+        executor:concurrent.futures.Executor
+            executor to use instead of creating one.
+        batch_size:int
+            number of plots converted to HSV together.
+        cache:bool
+            use the hue histograms of the raw data cache.
+
+        Returns
+        -------
+            DataFrame with a row per plot, date and hue range, and the
+            columns of Calcualte_green_pixels.
+        """
+        hists = self.hue_histograms(
+            Red,
+            Blue,
+            Green,
+            image_shape,
+            n_jobs=n_jobs,
+            executor=executor,
+            batch_size=batch_size,
+            cache=cache,
+        )
+        return _sweep_hue_ranges(hists, hue_ranges)
+
     def generate_unique_feature(
-        self, function, features_names: list, to_data=False
+        self,
+        function,
+        features_names: list,
+        to_data=False,
+        n_jobs=None,
+        executor=None,
+        backend="threads",
+        chunk_size=64,
     ):
         """Higher order function that iterate through the flight dates.
 
@@ -467,6 +863,14 @@ class Pynomicproject:
             name of the new features.
         to_data :bool
             merges it with the project data.
+        n_jobs :int
+            number of workers used to apply the function.
+        executor :concurrent.futures.Executor
+            executor to use instead of creating one.
+        backend :str
+            "threads" or "processes". See map_plot_arrays.
+        chunk_size :int
+            number of plots sent to a worker at a time.
 
         Returns
         -------
@@ -474,19 +878,17 @@ class Pynomicproject:
         """
         if isinstance(features_names, list):
             values_list = []
-            for flight_date in self.dates:
-                for plot in self.raw_data["dates"][flight_date].group_keys():
-                    bands_names = []
-                    bands_arr = []
-                    for band in self.bands_name:
-                        bands_names.append(band)
-                        bands_arr.append(
-                            self.raw_data["dates"][flight_date][plot][band][:]
-                        )
-                    values = function(dict(zip(bands_names, bands_arr)))
-                    values.insert(0, plot)
-                    values.insert(1, flight_date)
-                    values_list.append(values)
+            for flight_date, plot, values in self.map_plot_arrays(
+                function,
+                n_jobs=n_jobs,
+                executor=executor,
+                backend=backend,
+                chunk_size=chunk_size,
+            ):
+                values = list(values)
+                values.insert(0, plot)
+                values.insert(1, flight_date)
+                values_list.append(values)
 
             features_names.insert(0, "id")
             features_names.insert(1, "date")
@@ -504,8 +906,95 @@ class Pynomicproject:
         else:
             return print("feature_names is not a list")
 
+    def senescence_curves(self, from_day=0):
+        """Band curves of the plots shared by the senescence engines.
+
+        Parameters
+        ----------
+        from_day:int
+            only the days after this one are used.
+
+        Returns
+        -------
+            CurveData
+        """
+        return senescence.CurveData.from_ldata(self.ldata, from_day)
+
+    def get_threshold_sweep(
+        self,
+        bands,
+        thresholds,
+        from_day=0,
+        extrapolate=True,
+        curves=None,
+    ):
+        """Predictions of senecense for every threshold and band.
+
+        Equals calling get_threshold_estimation for each combination, but
+        the days and matrices are computed once and the crossings of all
+        the thresholds are found together.
+
+        Parameters
+        ----------
+        bands:str or list
+            band names to be used in the prediction.
+        thresholds:list
+            values to determen if a plot is dry or not, for example
+            np.arange(0.3, 0.71, 0.01).
+        from_day:int
+            only the days after this one are used.
+        extrapolate:bool
+            predict the plots out of range with splines, as
+            get_threshold_estimation. If False they get NaN.
+        curves:CurveData
+            curves returned by senescence_curves, reused between calls.
+            from_day is ignored when they are given.
+
+        Returns
+        -------
+            DataFrame with the columns band, threshold, id, dpred,
+            in_range and status.
+        """
+        if isinstance(bands, str):
+            bands = [bands]
+        if curves is None:
+            curves = self.senescence_curves(from_day)
+        return curves.sweep(bands, np.atleast_1d(thresholds), extrapolate)
+
+    def _predict_senescence(
+        self,
+        band,
+        threshold,
+        model,
+        to_data,
+        from_day,
+        curves,
+        n_jobs,
+        **kwargs,
+    ):
+        """Runs a senescence model of the shared curves on every plot."""
+        if curves is None:
+            curves = self.senescence_curves(from_day)
+        pred = curves.predict(band, threshold, model, n_jobs, **kwargs)
+        df1 = curves.to_frame(pred)
+        if to_data:
+            self.ldata = self.ldata.merge(
+                df1.loc[:, ["id", "num_day", "dpred", "in_range", "status"]],
+                on=["id"],
+                how="left",
+            )
+            return
+        return df1
+
     def get_threshold_estimation(
-        self, band: str, threshold: float, to_data: bool = False, from_day=0
+        self,
+        band: str,
+        threshold: float,
+        to_data: bool = False,
+        from_day=0,
+        engine="loop",
+        n_jobs=None,
+        curves=None,
     ):
         """Generates predictions of senecense by providing threshold and index.
 
@@ -517,11 +1006,36 @@ class Pynomicproject:
             value to determen if a plot is dry or not.
         to_data:bool
             boolean value to save or not the predictions.
+        engine:str
+            "loop" processes the plots one at a time. "vectorized" pivots
+            the data into a (plots x days) matrix and finds the crossings
+            of all the plots in range at once, with the same results.
+        n_jobs:int
+            number of processes that run the chunks of plots of the
+            engine, see CurveData.predict.
+        curves:CurveData
+            curves returned by senescence_curves, reused between calls.
+            from_day is ignored when they are given.
 
         Returns
         -------
-            Geodataframe
+            Geodataframe with a status column with the warnings of each
+            plot.
         """
+        if engine == "vectorized":
+            return self._predict_senescence(
+                band,
+                threshold,
+                "threshold",
+                to_data,
+                from_day,
+                curves,
+                n_jobs,
+            )
+        elif engine != "loop":
+            raise ValueError(
+                f"engine must be 'loop' or 'vectorized', not {engine!r}"
+            )
 
         def _case_in(plot, col_val, numerical_date_col, threshold):
             plot = plot.sort_values(
@@ -541,7 +1055,7 @@ class Pynomicproject:
                         ].values[0]
                         == threshold
                     ):
-                        return round(plotval)
+                        return round(plotval), "ok"
                     else:
                         ant_date = plot[numerical_date_col].values[plotpos - 1]
                         colant_val = plot.loc[
@@ -557,8 +1071,8 @@ class Pynomicproject:
                             np.array([threshold]).reshape(-1, 1)
                         )[0][0]
 
-                        return round(plotpred)
-            return -999
+                        return round(plotpred), "ok"
+            return -999, "no crossing"
 
         def _case_upper(plot, col_val, numerical_date_col, threshold):
             plot = plot.sort_values(
@@ -578,10 +1092,12 @@ class Pynomicproject:
 
             if result.success:
                 plotpred = result.x[0]
+                status = "upper than range"
             else:
                 plotpred = 0
+                status = "root not found"
 
-            return round(plotpred)
+            return round(plotpred), status
 
         def _case_lower(plot, col_val, numerical_date_col, threshold):
             plot = plot.sort_values(
@@ -601,10 +1117,12 @@ class Pynomicproject:
 
             if result.success:
                 plotpred = result.x[0]
+                status = "lower than range"
             else:
                 plotpred = -997
+                status = "root not found"
 
-            return round(plotpred)
+            return round(plotpred), status
 
         df1 = self.ldata.copy()
         plot_id_col = "id"
@@ -629,29 +1147,33 @@ class Pynomicproject:
                 plot[col_val].values[: int((len(plot[col_val]) / 2))].max()
                 >= threshold
             ):
-                df1.loc[df1[plot_id_col] == p, "dpred"] = _case_in(
+                dpred, status = _case_in(
                     plot, col_val, numerical_date_col, threshold
                 )
+                df1.loc[df1[plot_id_col] == p, "dpred"] = dpred
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "IN"
+                df1.loc[df1[plot_id_col] == p, "status"] = status
 
             # Second case if threshold is upper than the range in col_val
             elif (
                 plot[col_val].values[: int((len(plot[col_val]) / 2))].max()
                 < threshold
             ):
-                print(f"Plot Id: {p} threshold is upper than range")
-                df1.loc[df1[plot_id_col] == p, "dpred"] = _case_upper(
+                dpred, status = _case_upper(
                     plot, col_val, numerical_date_col, threshold
                 )
+                df1.loc[df1[plot_id_col] == p, "dpred"] = dpred
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "upper"
+                df1.loc[df1[plot_id_col] == p, "status"] = status
 
             # Third case if threshold is lower than the range in col_val
             elif plot[col_val].min() >= threshold:
-                print(f"Plot Id: {p} threshold is lower than range")
-                df1.loc[df1[plot_id_col] == p, "dpred"] = _case_lower(
+                dpred, status = _case_lower(
                     plot, col_val, numerical_date_col, threshold
                 )
+                df1.loc[df1[plot_id_col] == p, "dpred"] = dpred
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "lower"
+                df1.loc[df1[plot_id_col] == p, "status"] = status
 
         if to_data:
             self.ldata = self.ldata.merge(
@@ -662,6 +1184,7 @@ class Pynomicproject:
                         numerical_date_col,
                         "dpred",
                         "in_range",
+                        "status",
                     ],
                 ],
                 on=["id"],
@@ -677,31 +1200,106 @@ class Pynomicproject:
 
         return Pynomicplotter(self)
 
-    def save(self, path):
+    def save(self, path, storage=None, ldata_format="shapefile"):
         """Function to save project in a directory.
 
         Parameters
         ----------
         path:str
             Name of the directory.
+        storage:str or StorageProfile
+            rewrites the plot arrays with this compressor, dtype and
+            chunking. A name of storage.STORAGE_PROFILES or a
+            StorageProfile. None copies the arrays as they are, except
+            for projects read with dates or ids, whose selected arrays
+            are rewritten with the default profile.
+        ldata_format:str
+            "shapefile" writes ldata.shp. "parquet" writes ldata.parquet
+            as GeoParquet, which keeps the full column names and can be
+            read back by columns and rows (needs pyarrow).
 
         Returns
         -------
             A directory with the Pynomicproject folders.
         """
-        out_store = zarr.DirectoryStore(path + "/" + "raw_data")
-        zarr.copy_store(self.raw_data.store, out_store)
-
-        self.ldata.to_file(path + "/" + "ldata.shp", driver="ESRI Shapefile")
+        raw_path = path + "/" + "raw_data"
+        # The chunk store is the underlying store also when the project was
+        # opened with consolidated metadata.
+        store = self.raw_data.chunk_store
+        in_place = isinstance(store, zarr.DirectoryStore) and (
+            os.path.abspath(store.path) == os.path.abspath(raw_path)
+        )
+        raw_dates = set(self.raw_data["dates"].group_keys())
+        selection = self._plots is not None or set(self.dates) != raw_dates
+        if in_place and (self._partial or selection):
+            raise ValueError(
+                "The project was read with columns, dates or ids filters, "
+                "save it to another path"
+            )
+        if in_place and storage is not None:
+            raise ValueError(
+                "The raw data is already stored in path, give the storage "
+                "profile to process_stack_tiff or save to another path"
+            )
+        # Projects streamed to this directory already have their arrays.
+        if selection:
+            out_group = zarr.open_group(
+                zarr.DirectoryStore(raw_path), mode="w"
+            )
+            self._copy_selection(out_group, storage)
+        elif storage is not None:
+            out_group = zarr.open_group(
+                zarr.DirectoryStore(raw_path), mode="w"
+            )
+            copy_with_profile(self.raw_data, out_group, storage)
+        elif not in_place:
+            out_store = zarr.DirectoryStore(raw_path)
+            zarr.copy_store(store, out_store)
+        # A single .zmetadata file lets read_zarr open the project without
+        # reading the metadata of every group and array.
+        zarr.consolidate_metadata(zarr.DirectoryStore(raw_path))
+
+        if ldata_format == "parquet":
+            self.ldata.to_parquet(path + "/" + "ldata.parquet", index=False)
+        elif ldata_format == "shapefile":
+            self.ldata.to_file(
+                path + "/" + "ldata.shp", driver="ESRI Shapefile"
+            )
+        else:
+            raise ValueError(
+                f"ldata_format must be 'shapefile' or 'parquet', "
+                f"not {ldata_format!r}"
+            )
         prop_dic = {
             "dates": self.dates,
             "bands": self.bands_name,
+            "ldata_format": ldata_format,
         }
         with open(path + "/" + "obj_properties.json", mode="w") as outfile:
             json.dump(prop_dic, outfile)
 
         return
 
+    def _copy_selection(self, out_group, storage=None):
+        """Writes the arrays of the selected dates and plots to a group.
+
+        Each date keeps its layout, the ragged dates are written again
+        with the selected plots only.
+        """
+        from ..io.get_plot_bands import _WRITERS
+
+        profile = get_profile(storage)
+        dates_group = out_group.create_group("dates")
+        for date in self.dates:
+            layout = self.raw_data["dates"][date].attrs.get("layout")
+            writer = _WRITERS[layout or "groups"](
+                dates_group.create_group(date), profile
+            )
+            for _, plot, arrays in self.iter_plot_arrays(dates=[date]):
+                writer.write(plot, arrays)
+            writer.close()
+        return
+
     def save_indiv_plots_images(
         self, folder_path, fun, identification_col, file_type: str
     ):
@@ -722,29 +1320,31 @@ class Pynomicproject:
             folder with images.
         """
         for d in self.dates:
+            os.mkdir(os.path.join(folder_path, d))
+        for d, p, bands in self.iter_plot_arrays():
             path = os.path.join(folder_path, d)
-            os.mkdir(path)
-            for p in self.raw_data["dates"][d].group_keys():
-                bands_names = []
-                bands_arr = []
-                for band in self.bands_name:
-                    bands_names.append(band)
-                    bands_arr.append(self.raw_data["dates"][d][p][band][:])
-                arrays = fun(dict(zip(bands_names, bands_arr)))
-                name = str(
-                    self.ldata.loc[
-                        self.ldata["id"] == p, identification_col
-                    ].unique()[0]
-                )
-                if file_type == "tiff":
-                    image_path = os.path.join(path, name + ".tiff")
-                if file_type == "jpg":
-                    image_path = os.path.join(path, name + ".jpg")
-                image = Image.fromarray(arrays)
-                image.save(image_path)
+            arrays = fun(bands)
+            name = str(
+                self.ldata.loc[
+                    self.ldata["id"] == p, identification_col
+                ].unique()[0]
+            )
+            if file_type == "tiff":
+                image_path = os.path.join(path, name + ".tiff")
+            if file_type == "jpg":
+                image_path = os.path.join(path, name + ".jpg")
+            image = Image.fromarray(arrays)
+            image.save(image_path)
 
     def get_senescens_Splines_predictions(
-        self, band: str, threshold: float, to_data: bool = False, from_day=0
+        self,
+        band: str,
+        threshold: float,
+        to_data: bool = False,
+        from_day=0,
+        engine="loop",
+        n_jobs=None,
+        curves=None,
     ):
         """Generates predictions of senecense by providing threshold using the spline method.
 
@@ -756,11 +1356,39 @@ class Pynomicproject:
             value to determen if a plot is dry or not.
         to_data:bool
             boolean value to save or not the predictions.
+        engine:str
+            "loop" searches the root of each spline from an initial guess.
+            "batched" groups the data once, evaluates the splines on a
+            shared grid of days and takes the crossing nearest to the
+            initial guess. Both agree unless a spline crosses the
+            threshold several times and the root search drifts away
+            from the guess.
+        n_jobs:int
+            number of processes that run the chunks of plots of the
+            engine, see CurveData.predict.
+        curves:CurveData
+            curves returned by senescence_curves, reused between calls.
+            from_day is ignored when they are given.
 
         Returns
         -------
-            Geodataframe
+            Geodataframe with a status column with the warnings of each
+            plot.
         """
+        if engine == "batched":
+            return self._predict_senescence(
+                band,
+                threshold,
+                "splines",
+                to_data,
+                from_day,
+                curves,
+                n_jobs,
+            )
+        elif engine != "loop":
+            raise ValueError(
+                f"engine must be 'loop' or 'batched', not {engine!r}"
+            )
 
         def _case_in(plot, col_val, numerical_date_col, threshold):
             plot = plot.sort_values(numerical_date_col, ascending=True)
@@ -826,10 +1454,12 @@ class Pynomicproject:
 
             if result.success:
                 plotpred = result.x[0]
+                status = "ok"
             else:
                 plotpred = 0
+                status = "root not found"
 
-            return round(plotpred)
+            return round(plotpred), status
 
         def _case_upper(plot, col_val, numerical_date_col, threshold):
             plot = plot.sort_values(
@@ -849,10 +1479,12 @@ class Pynomicproject:
 
             if result.success:
                 plotpred = result.x[0]
+                status = "upper than range"
             else:
                 plotpred = 0
+                status = "root not found"
 
-            return round(plotpred)
+            return round(plotpred), status
 
         def _case_lower(plot, col_val, numerical_date_col, threshold):
             plot = plot.sort_values(
@@ -872,10 +1504,12 @@ class Pynomicproject:
 
             if result.success:
                 plotpred = result.x[0]
+                status = "lower than range"
             else:
                 plotpred = -997
+                status = "root not found"
 
-            return round(plotpred)
+            return round(plotpred), status
 
         df1 = self.ldata.copy()
         plot_id_col = "id"
@@ -900,29 +1534,33 @@ class Pynomicproject:
                 plot[col_val].values[: int((len(plot[col_val]) / 2))].max()
                 >= threshold
             ):
-                df1.loc[df1[plot_id_col] == p, "dpred"] = _case_in(
+                dpred, status = _case_in(
                     plot, col_val, numerical_date_col, threshold
                 )
+                df1.loc[df1[plot_id_col] == p, "dpred"] = dpred
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "IN"
+                df1.loc[df1[plot_id_col] == p, "status"] = status
 
             # Second case if threshold is upper than the range in col_val
             elif (
                 plot[col_val].values[: int((len(plot[col_val]) / 2))].max()
                 < threshold
             ):
-                print(f"Plot Id: {p} threshold is upper than range ")
-                df1.loc[df1[plot_id_col] == p, "dpred"] = _case_upper(
+                dpred, status = _case_upper(
                     plot, col_val, numerical_date_col, threshold
                 )
+                df1.loc[df1[plot_id_col] == p, "dpred"] = dpred
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "upper"
+                df1.loc[df1[plot_id_col] == p, "status"] = status
 
             # Third case if threshold is lower than the range in col_val
             elif plot[col_val].min() >= threshold:
-                print(f"Plot Id: {p} threshold is lower than range ")
-                df1.loc[df1[plot_id_col] == p, "dpred"] = _case_lower(
+                dpred, status = _case_lower(
                     plot, col_val, numerical_date_col, threshold
                 )
+                df1.loc[df1[plot_id_col] == p, "dpred"] = dpred
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "lower"
+                df1.loc[df1[plot_id_col] == p, "status"] = status
 
         if to_data:
             self.ldata = self.ldata.merge(
@@ -933,6 +1571,7 @@ class Pynomicproject:
                         numerical_date_col,
                         "dpred",
                         "in_range",
+                        "status",
                     ],
                 ],
                 on=["id"],
@@ -948,6 +1587,9 @@ class Pynomicproject:
         frac_val=0.5,
         to_data: bool = False,
         from_day=0,
+        engine="loop",
+        n_jobs=None,
+        curves=None,
     ):
         """Generates predictions of senecense by providing threshold.
 
@@ -959,11 +1601,38 @@ class Pynomicproject:
             value to determen if a plot is dry or not.
         to_data:bool
             boolean value to save or not the predictions.
+        engine:str
+            "loop" smooths each plot with statsmodels lowess. "matrix"
+            computes the LOESS weights once for each vector of days and
+            smooths all the plots that share it together. The smoothed
+            values are the same up to floating point rounding.
+        n_jobs:int
+            number of processes that run the chunks of plots of the
+            engine, see CurveData.predict.
+        curves:CurveData
+            curves returned by senescence_curves, reused between calls.
+            from_day is ignored when they are given.
 
         Returns
         -------
-            Geodataframe
+            Geodataframe with a status column with the warnings of each
+            plot.
         """
+        if engine == "matrix":
+            return self._predict_senescence(
+                band,
+                threshold,
+                "loess",
+                to_data,
+                from_day,
+                curves,
+                n_jobs,
+                frac=frac_val,
+            )
+        elif engine != "loop":
+            raise ValueError(
+                f"engine must be 'loop' or 'matrix', not {engine!r}"
+            )
 
         def _case_in(
             plot, col_val, numerical_date_col, threshold, frac_val=frac_val
@@ -1061,6 +1730,7 @@ class Pynomicproject:
                     plot, col_val, numerical_date_col, threshold
                 )
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "IN"
+                df1.loc[df1[plot_id_col] == p, "status"] = "ok"
 
             # Second case if threshold is upper than the range in col_val
             # takes the first highes values and compares them.
@@ -1068,19 +1738,19 @@ class Pynomicproject:
                 plot[col_val].values[: int((len(plot[col_val]) / 2))].max()
                 < threshold
             ):
-                print(f"Plot Id: {p} threshold is upper than range ")
                 df1.loc[df1[plot_id_col] == p, "dpred"] = _case_upper(
                     plot, col_val, numerical_date_col, threshold
                 )
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "upper"
+                df1.loc[df1[plot_id_col] == p, "status"] = "upper than range"
 
             # Third case if threshold is lower than the range in col_val
             elif plot[col_val].min() >= threshold:
-                print(f"Plot Id: {p} threshold is lower than range")
                 df1.loc[df1[plot_id_col] == p, "dpred"] = _case_lower(
                     plot, col_val, numerical_date_col, threshold
                 )
                 df1.loc[df1[plot_id_col] == p, "in_range"] = "lower"
+                df1.loc[df1[plot_id_col] == p, "status"] = "lower than range"
 
         if to_data:
             self.ldata = self.ldata.merge(
@@ -1091,6 +1761,7 @@ class Pynomicproject:
                         numerical_date_col,
                         "dpred",
                         "in_range",
+                        "status",
                     ],
                 ],
                 on=["id"],
@@ -1098,3 +1769,294 @@ class Pynomicproject:
             )
         else:
             return df1
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def _chunk_reader(arr, max_chunks=4):
+    """Returns a function that reads runs of a 1-D array by chunks.
+
+    The decoded chunks are kept in a small LRU cache, so the plots of the
+    ragged layout that share a chunk decode it once. Each chunk has its
+    own future, the prefetch threads wait only for a chunk that another
+    one is decoding and decode the others in parallel. The runs are
+    copied out of the chunks, so they do not keep them in memory.
+    """
+    size = arr.chunks[0]
+    cache = OrderedDict()
+    lock = threading.Lock()
+
+    def _chunk(i):
+        with lock:
+            future = cache.get(i)
+            decode = future is None
+            if decode:
+                future = cache[i] = Future()
+                if len(cache) > max_chunks:
+                    cache.popitem(last=False)
+            else:
+                cache.move_to_end(i)
+        if decode:
+            try:
+                future.set_result(arr[i * size : (i + 1) * size])
+            except BaseException as err:
+                future.set_exception(err)
+                with lock:
+                    if cache.get(i) is future:
+                        del cache[i]
+        return future.result()
+
+    def _read(start, end):
+        out = np.empty(max(end - start, 0), dtype=arr.dtype)
+        if not len(out):
+            return out
+        for i in range(start // size, (end - 1) // size + 1):
+            lo, hi = max(start, i * size), min(end, (i + 1) * size)
+            out[lo - start : hi - start] = _chunk(i)[
+                lo - i * size : hi - i * size
+            ]
+        return out
+
+    return _read
+
+
+def _apply_chunk(function, chunk):
+    """Applies a function to a list of bands dicts."""
+    return [function(arrays) for arrays in chunk]
+
+
+_GLCM_PROPS = {
+    "cont": "contrast",
+    "disst": "dissimilarity",
+    "homog": "homogeneity",
+    "energy": "energy",
+    "corr": "correlation",
+}
+
+
+def _glcm_feature_names(bands, distances, angles):
+    """Names of the GLCM features, ordered by angle, distance and band."""
+    return [
+        b + "_" + str(dist) + "_" + str(angl) + "_" + prop
+        for angl in angles
+        for dist in distances
+        for b in bands
+        for prop in _GLCM_PROPS
+    ]
+
+
+def _glcm_features(arrays, distances, angles, bands, levels=256):
+    """Calculates the GLCM features of the bands of a plot.
+
+    The co-occurrences of all the distances and angles of a band are
+    counted in a single pass.
+
+    Parameters
+    ----------
+    arrays :dict
+        array of each band.
+    distances :list
+        distances of the matrix.
+    angles :list
+        angles of the matrix.
+    bands :list
+        bands to use.
+    levels :int
+        gray levels of the matrix.
+
+    Returns
+    -------
+        list with the features in the order of _glcm_feature_names.
+    """
+    band_props = {}
+    for b in bands:
+        gray = arrays[b]
+        if not np.issubdtype(gray.dtype, np.uint8):
+            gray = gray.astype(float)
+            gray *= 255 / np.round(gray, 6).max()
+            gray = np.uint8(np.round(gray, 0).astype(int))
+        if levels != 256:
+            gray = (gray.astype(np.uint16) * levels // 256).astype(np.uint8)
+        glcm = graycomatrix(
+            gray,
+            distances=distances,
+            angles=angles,
+            levels=levels,
+            symmetric=True,
+            normed=True,
+        )
+        # Each property of all the distances and angles at once.
+        band_props[b] = np.round(
+            np.stack([graycoprops(glcm, p) for p in _GLCM_PROPS.values()]),
+            4,
+        )
+
+    return [
+        float(band_props[b][k, i, j])
+        for j in range(len(angles))
+        for i in range(len(distances))
+        for b in bands
+        for k in range(len(_GLCM_PROPS))
+    ]
+
+
+_N_HUES = 180
+
+
+def _normalized_rgb(arrays, red, green, blue, image_shape):
+    """Stacks the bands of a plot as an 8 bits RGB image."""
+    bands = []
+    for b in (red, green, blue):
+        band = arrays[b]
+        if len(image_shape) >= 4:
+            band = band[
+                image_shape[0] : image_shape[1],
+                image_shape[2] : image_shape[3],
+            ]
+        bands.append(
+            cv2.normalize(band, None, 255, 0, cv2.NORM_MINMAX, cv2.CV_8U)
+        )
+    return np.dstack(bands)
+
+
+def _packed_hsv(batch, red, green, blue, image_shape):
+    """Converts a batch of plots to HSV in a single call.
+
+    The pixels of all the plots are packed in one row, so the conversion
+    is done once for the whole batch.
+
+    Returns
+    -------
+        tuple with the HSV pixels, shape (1, n_pixels, 3), and the first
+        pixel of each plot.
+    """
+    images = [
+        _normalized_rgb(arrays, red, green, blue, image_shape).reshape(-1, 3)
+        for arrays in batch
+    ]
+    sizes = np.array([len(img) for img in images])
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    packed = np.concatenate(images)[np.newaxis]
+    return cv2.cvtColor(packed, cv2.COLOR_RGB2HSV), offsets, sizes
+
+
+def _green_pixels_batch(
+    batch, red, green, blue, image_shape, min_val, max_val
+):
+    """Counts the green pixels of a batch of plots.
+
+    Returns
+    -------
+        list with the green fraction, green pixels and non-green pixels of
+        each plot.
+    """
+    hsv, offsets, sizes = _packed_hsv(batch, red, green, blue, image_shape)
+    mask = cv2.inRange(hsv, (min_val, 25, 25), (max_val, 255, 255))[0]
+    # Green pixels of each plot from the cumulative count of the batch.
+    cum_green = np.concatenate([[0], np.cumsum(mask == 255)])
+    n_green = cum_green[offsets + sizes] - cum_green[offsets]
+    return [
+        _green_values(val255, size)
+        for val255, size in zip(n_green.tolist(), sizes.tolist())
+    ]
+
+
+def _green_values(val255, size):
+    """Green fraction, green pixels and non-green pixels of a plot."""
+    val0 = size - val255
+    if val255 == 0:
+        return [0, 0, val0]
+    if val0 == 0:
+        return [1, val255, 0]
+    return [np.round(val255 / size, 2), val255, val0]
+
+
+def _hue_histograms_batch(batch, red, green, blue, image_shape):
+    """Hue histograms of a batch of plots.
+
+    Only the pixels with saturation and value of at least 25 are counted,
+    as in the green pixels mask.
+
+    Returns
+    -------
+        list with an array per plot, the counts of the 180 hues followed
+        by the number of pixels of the plot.
+    """
+    hsv, offsets, sizes = _packed_hsv(batch, red, green, blue, image_shape)
+    hsv = hsv[0]
+    valid = (hsv[:, 1] >= 25) & (hsv[:, 2] >= 25)
+    plot_idx = np.repeat(np.arange(len(batch)), sizes)
+    hist = np.bincount(
+        plot_idx[valid] * _N_HUES + hsv[valid, 0],
+        minlength=len(batch) * _N_HUES,
+    ).reshape(len(batch), _N_HUES)
+    return list(np.column_stack([hist, sizes]))
+
+
+def _cached_hists(cache_group, date, revision):
+    """Reads the cached hue histograms of a date.
+
+    Returns
+    -------
+        dict with the histogram of each cached plot, empty when the date
+        is not cached or was written again.
+    """
+    if date not in cache_group:
+        return {}
+    arr = cache_group[date]
+    if arr.attrs.get("revision") != revision:
+        return {}
+    hists = arr[:]
+    return {p: hists[i] for i, p in enumerate(arr.attrs["plots"])}
+
+
+def _sweep_hue_ranges(hists, hue_ranges):
+    """Green pixels of each hue range from the hue histograms.
+
+    Parameters
+    ----------
+    hists :DataFrame
+        hue histograms returned by Pynomicproject.hue_histograms.
+    hue_ranges :list
+        list of (min_val, max_val) hue ranges.
+
+    Returns
+    -------
+        DataFrame with a row per plot, date and hue range.
+    """
+    counts = hists[list(range(_N_HUES))].to_numpy()
+    # Cumulative counts give the pixels of any hue range with a difference.
+    cum = np.concatenate(
+        [np.zeros((len(counts), 1), dtype=counts.dtype), counts.cumsum(1)],
+        axis=1,
+    )
+    sizes = hists["n_px"].tolist()
+    dates = hists.index.get_level_values("date")
+    ids = hists.index.get_level_values("id")
+
+    values_list = []
+    for min_val, max_val in hue_ranges:
+        low = min(max(min_val, 0), _N_HUES)
+        high = min(max(max_val + 1, low), _N_HUES)
+        n_green = (cum[:, high] - cum[:, low]).tolist()
+        for plot, flight_date, val255, size in zip(ids, dates, n_green, sizes):
+            values_list.append(
+                [plot, flight_date, min_val, max_val]
+                + _green_values(val255, size)
+            )
+
+    return pd.DataFrame(
+        values_list,
+        columns=[
+            "id",
+            "date",
+            "min_val",
+            "max_val",
+            "perc_green",
+            "N_green_px",
+            "N_non_green_px",
+        ],
+    )
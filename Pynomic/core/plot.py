@@ -17,7 +17,6 @@ import pandas as pd
 
 import numpy as np
 
-
 # =============================================================================
 # CLASSES
 # =============================================================================
@@ -128,15 +127,10 @@ class Pynomicplotter:
             dates = pd.DataFrame(self.ldata.date.unique(), columns=["date"])
             dates["datet"] = pd.to_datetime(dates["date"])
             dates = dates.loc[dates.datet.sort_values().index].reset_index()
-            for dat in dates["date"].values:
-                bands_names = []
-                bands_arr = []
-                for band in self.bands_name:
-                    bands_names.append(band)
-                    bands_arr.append(
-                        self.raw_data["dates"][dat][n_id][band][:]
-                    )
-                imlist.append(function(dict(zip(bands_names, bands_arr))))
+            for _, _, arrays in self.iter_plot_arrays(
+                dates=dates["date"].values, plots=[n_id]
+            ):
+                imlist.append(function(arrays))
             return imlist
 
         array_list = _get_arrays(self._summary, n_id=n_id, function=function)
@@ -285,17 +279,12 @@ class Pynomicplotter:
             dates = pd.DataFrame(self.ldata.date.unique(), columns=["date"])
             dates["datet"] = pd.to_datetime(dates["date"])
             dates = dates.loc[dates.datet.sort_values().index].reset_index()
-            for dat in dates["date"].values:
-                bands_names = []
-                bands_arr = []
-                for band in self.bands_name:
-                    bands_names.append(band)
-                    bands_arr.append(
-                        self.raw_data["dates"][dat][n_id][band][:]
-                    )
+            for _, _, arrays in self.iter_plot_arrays(
+                dates=dates["date"].values, plots=[n_id]
+            ):
                 imlist.append(
                     function(
-                        dict(zip(bands_names, bands_arr)),
+                        arrays,
                         red1=Red,
                         green1=Green,
                         blue1=Blue,
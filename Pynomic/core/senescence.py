@@ -0,0 +1,824 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: MIT
+# Copyright (c) 2024, Fiore J.Manuel.
+# All rights reserved.
+
+"""Provides the vectorized engines of the senescence predictions."""
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+import attrs
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from scipy.interpolate import UnivariateSpline
+from scipy.optimize import brentq, root
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+
+@attrs.define
+class CurveMatrix:
+    """Days and values of a band of every plot as (plots x days) matrices.
+
+    Each row has the observations of a plot sorted by day, padded with NaN
+    when the plot has less observations than the others.
+
+    Parameters
+    ----------
+    ids :np.array
+        id of each plot, in order of appearance in the data.
+    days :np.array
+        days of the observations.
+    values :np.array
+        band values of the observations.
+    half_max :np.array
+        maximum of each plot in the first half of its rows.
+    min :np.array
+        minimum of each plot.
+    """
+
+    ids: np.ndarray
+    days: np.ndarray
+    values: np.ndarray
+    half_max: np.ndarray
+    min: np.ndarray
+
+    @classmethod
+    def from_frame(cls, df, band, plot_id_col="id", day_col="num_day"):
+        """Builds the matrices from a long DataFrame.
+
+        Parameters
+        ----------
+        df :DataFrame
+            data with a row per plot and date.
+        band :str
+            column with the values.
+        plot_id_col :str
+            column with the plot ids.
+        day_col :str
+            column with the numerical day.
+
+        Returns
+        -------
+            CurveMatrix
+        """
+        codes, ids = pd.factorize(df[plot_id_col])
+        n_plots = len(ids)
+        days = df[day_col].to_numpy(dtype=float)
+        vals = df[band].to_numpy(dtype=float)
+
+        # The first half is taken in the order of the rows of each plot.
+        pos = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+        half = np.bincount(codes, minlength=n_plots) // 2
+        in_half = pos < half[codes]
+        half_max = np.full(n_plots, np.nan)
+        np.fmax.at(half_max, codes[in_half], vals[in_half])
+        vmin = np.full(n_plots, np.nan)
+        np.fmin.at(vmin, codes, vals)
+
+        valid = ~np.isnan(vals)
+        codes, days, vals = codes[valid], days[valid], vals[valid]
+        order = np.lexsort((days, codes))
+        codes, days, vals = codes[order], days[order], vals[order]
+        rank = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+        width = rank.max() + 1 if len(rank) else 0
+
+        day_mtx = np.full((n_plots, width), np.nan)
+        val_mtx = np.full((n_plots, width), np.nan)
+        day_mtx[codes, rank] = days
+        val_mtx[codes, rank] = vals
+
+        return cls(
+            ids=np.asarray(ids),
+            days=day_mtx,
+            values=val_mtx,
+            half_max=half_max,
+            min=vmin,
+        )
+
+    def plot_curve(self, pos):
+        """Days and values of the plot in a row of the matrix."""
+        n_obs = int(np.count_nonzero(~np.isnan(self.values[pos])))
+        return self.days[pos, :n_obs], self.values[pos, :n_obs]
+
+    def take(self, rows):
+        """Matrix with some rows (plots) of this one."""
+        return CurveMatrix(
+            ids=self.ids[rows],
+            days=self.days[rows],
+            values=self.values[rows],
+            half_max=self.half_max[rows],
+            min=self.min[rows],
+        )
+
+
+@attrs.define
+class CurveData:
+    """Band curves of the plots, shared by the senescence models.
+
+    The numerical days are computed once and the (plots x days) matrix of
+    each band is built the first time it is used, so the same matrices
+    serve many thresholds, bands and models.
+
+    Parameters
+    ----------
+    frame :DataFrame
+        data of the plots with the num_day column.
+    """
+
+    frame: pd.DataFrame
+    _matrices: dict = attrs.field(factory=dict, repr=False)
+
+    @classmethod
+    def from_ldata(cls, ldata, from_day=0):
+        """Builds the curves from the data of a project.
+
+        Parameters
+        ----------
+        ldata :DataFrame
+            data with a row per plot and date.
+        from_day :int
+            only the days after this one are used.
+
+        Returns
+        -------
+            CurveData
+        """
+        frame = ldata.copy()
+        frame["num_day"] = day_numbers(frame.date)
+        if from_day > 0:
+            frame = frame.loc[frame.num_day > from_day].copy()
+        return cls(frame=frame)
+
+    def matrix(self, band):
+        """Curve matrix of a band, built once and cached."""
+        if band not in self._matrices:
+            self._matrices[band] = CurveMatrix.from_frame(self.frame, band)
+        return self._matrices[band]
+
+    def predict(
+        self,
+        band,
+        threshold,
+        model="threshold",
+        n_jobs=None,
+        chunk_size=1024,
+        **kwargs,
+    ):
+        """Predicts the day of senescence of every plot.
+
+        Parameters
+        ----------
+        band :str
+            band of the curves.
+        threshold :float
+            value to determine if a plot is dry or not.
+        model :str
+            "threshold", "splines" or "loess".
+        n_jobs :int
+            number of processes that run the chunks of plots. None runs
+            them in this process.
+        chunk_size :int
+            number of plots of each chunk.
+        kwargs :
+            arguments of the model, like frac for "loess".
+
+        Returns
+        -------
+            DataFrame with the id, dpred, in_range and status of each plot.
+        """
+        if model not in _MODELS:
+            raise ValueError(
+                f"model must be one of {list(_MODELS)}, not {model!r}"
+            )
+        matrix = self.matrix(band)
+        if model == "splines" and len(matrix.ids):
+            kwargs.setdefault(
+                "day_range",
+                (np.nanmin(matrix.days), np.nanmax(matrix.days)),
+            )
+
+        n_plots = len(matrix.ids)
+        chunks = [
+            matrix.take(slice(i, i + chunk_size))
+            for i in range(0, n_plots, chunk_size)
+        ]
+        run = partial(
+            _predict_chunk, model=model, threshold=threshold, kwargs=kwargs
+        )
+        if n_jobs is not None and n_jobs > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(run, chunks))
+        else:
+            results = list(map(run, chunks))
+
+        if results:
+            dpred, case, status = map(np.concatenate, zip(*results))
+        else:
+            dpred, case, status = np.array([]), [], []
+        return pd.DataFrame(
+            {
+                "id": matrix.ids,
+                "dpred": dpred,
+                "in_range": case,
+                "status": status,
+            }
+        )
+
+    def sweep(self, bands, thresholds, extrapolate=True):
+        """Predicts the day of senescence for many bands and thresholds.
+
+        Parameters
+        ----------
+        bands :list
+            bands of the curves.
+        thresholds :list
+            values to determine if a plot is dry or not.
+        extrapolate :bool
+            search the day of the plots out of range with the splines.
+
+        Returns
+        -------
+            DataFrame with a row per band, threshold and plot and the
+            columns band, threshold, id, dpred, in_range and status.
+        """
+        thresholds = np.asarray(thresholds, dtype=float)
+        frames = []
+        for band in bands:
+            matrix = self.matrix(band)
+            dpred, case, status = threshold_sweep(
+                matrix, thresholds, extrapolate
+            )
+            frames.append(
+                pd.DataFrame(
+                    {
+                        "band": band,
+                        "threshold": np.repeat(thresholds, len(matrix.ids)),
+                        "id": np.tile(matrix.ids, len(thresholds)),
+                        "dpred": dpred.ravel(),
+                        "in_range": case.ravel(),
+                        "status": status.ravel(),
+                    }
+                )
+            )
+        return pd.concat(frames, ignore_index=True)
+
+    def to_frame(self, predictions):
+        """Copy of the data with the predictions of each plot.
+
+        Parameters
+        ----------
+        predictions :DataFrame
+            result of predict.
+
+        Returns
+        -------
+            DataFrame
+        """
+        df = self.frame.copy()
+        pred = predictions.set_index("id")
+        for col in ["dpred", "in_range", "status"]:
+            df[col] = df["id"].map(pred[col])
+        return df
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def day_numbers(dates):
+    """Days since the first date.
+
+    Parameters
+    ----------
+    dates :Series
+        dates of the observations.
+
+    Returns
+    -------
+        Series with the number of days.
+    """
+    dt = pd.to_datetime(dates)
+    return (dt - dt.min()).dt.days
+
+
+def threshold_cases(matrix, threshold):
+    """Classifies each plot by the position of the threshold in its range.
+
+    Returns
+    -------
+        tuple with the boolean arrays of the plots where the threshold is
+        in range, upper and lower than the range.
+    """
+    in_range = (matrix.min <= threshold) & (matrix.half_max >= threshold)
+    upper = ~in_range & (matrix.half_max < threshold)
+    lower = ~in_range & ~upper & (matrix.min >= threshold)
+    return in_range, upper, lower
+
+
+def threshold_crossing(days, values, threshold):
+    """Day of the first crossing of the threshold of each row.
+
+    The day is interpolated linearly between the last observation above
+    the threshold and the first one at or below it, skipping the first
+    observation.
+
+    Parameters
+    ----------
+    days :np.array
+        (plots x days) matrix with the days.
+    values :np.array
+        (plots x days) matrix with the values.
+    threshold :float or np.array
+        value to cross, or 1-D array with several values.
+
+    Returns
+    -------
+        np.array with the rounded day, -999 when the row never crosses.
+        Has shape (thresholds x plots) when several thresholds are given.
+    """
+    threshold = np.asarray(threshold, dtype=float)
+    below = values <= threshold[..., None, None]
+    below[..., 0] = False
+    crosses = below.any(axis=-1)
+    pos = below.argmax(axis=-1)
+    rows = np.arange(len(values))
+
+    d0, d1 = days[rows, pos - 1], days[rows, pos]
+    v0, v1 = values[rows, pos - 1], values[rows, pos]
+    threshold = threshold[..., None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pred = d0 + (threshold - v0) * (d1 - d0) / (v1 - v0)
+    # A line fitted to two equal values predicts the mean day.
+    pred = np.where(v1 == v0, (d0 + d1) / 2, pred)
+    pred = np.where(v1 == threshold, d1, pred)
+    return np.where(crosses, np.round(pred), -999)
+
+
+def spline_roots(x, y, thresholds, initial_guess):
+    """Days where a smoothing spline of the values reaches each threshold.
+
+    The spline is fitted once and the root search is repeated for each
+    threshold.
+
+    Parameters
+    ----------
+    x :np.array
+        days.
+    y :np.array
+        values.
+    thresholds :list
+        values to reach.
+    initial_guess :float
+        day where the root searches start.
+
+    Returns
+    -------
+        list with the rounded day of each threshold, None when the search
+        fails.
+    """
+    spl = UnivariateSpline(x, y, k=3, s=4)
+    days = []
+    for threshold in thresholds:
+        result = root(lambda x_val: spl(x_val) - threshold, initial_guess)
+        days.append(round(result.x[0]) if result.success else None)
+    return days
+
+
+def spline_root(x, y, threshold, initial_guess):
+    """Day where a smoothing spline of the values reaches the threshold.
+
+    Parameters
+    ----------
+    x :np.array
+        days.
+    y :np.array
+        values.
+    threshold :float
+        value to reach.
+    initial_guess :float
+        day where the root search starts.
+
+    Returns
+    -------
+        rounded day, None when the search fails.
+    """
+    return spline_roots(x, y, [threshold], initial_guess)[0]
+
+
+def _case_status(case, upper, lower):
+    """Status of each plot from its case, before the prediction."""
+    status = np.full(len(case), "no case", dtype=object)
+    status[case == "IN"] = "ok"
+    status[upper] = "upper than range"
+    status[lower] = "lower than range"
+    return status
+
+
+def _fill_failed(dpred, status, rows, preds, failed):
+    """Stores the spline predictions of some rows, marking the failures."""
+    preds = np.array([np.nan if p is None else p for p in preds], float)
+    miss = np.isnan(preds)
+    dpred[rows] = np.where(miss, failed, preds)
+    status[rows[miss]] = "root not found"
+    return
+
+
+def threshold_estimation(matrix, threshold):
+    """Predicts the day of senescence of every plot.
+
+    Plots whose range contains the threshold are interpolated together,
+    the others are extrapolated with a smoothing spline.
+
+    Parameters
+    ----------
+    matrix :CurveMatrix
+        days and values of the plots.
+    threshold :float
+        value to determine if a plot is dry or not.
+
+    Returns
+    -------
+        tuple with the predicted day, the case ("IN", "upper" or "lower")
+        and the status of each plot. Plots that match no case get NaN.
+    """
+    dpred, case, status = threshold_sweep(matrix, [threshold])
+    return dpred[0], case[0], status[0]
+
+
+def threshold_sweep(matrix, thresholds, extrapolate=True):
+    """Predicts the day of senescence of every plot for many thresholds.
+
+    Gives the results of threshold_estimation for each threshold. The
+    crossings of all the thresholds and plots are interpolated in a
+    single pass, and the spline of a plot out of range is fitted once for
+    all its thresholds.
+
+    Parameters
+    ----------
+    matrix :CurveMatrix
+        days and values of the plots.
+    thresholds :np.array
+        values to determine if a plot is dry or not.
+    extrapolate :bool
+        search the day of the plots out of range with the splines. If
+        False they get NaN.
+
+    Returns
+    -------
+        tuple with the predicted day, the case and the status, as
+        (thresholds x plots) arrays.
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    t = thresholds[:, None]
+    in_range = (matrix.min <= t) & (matrix.half_max >= t)
+    upper = ~in_range & (matrix.half_max < t)
+    lower = ~in_range & ~upper & (matrix.min >= t)
+
+    dpred = np.where(
+        in_range,
+        threshold_crossing(matrix.days, matrix.values, thresholds),
+        np.nan,
+    )
+    case = np.full(dpred.shape, np.nan, dtype=object)
+    case[in_range] = "IN"
+    case[upper] = "upper"
+    case[lower] = "lower"
+    status = np.full(dpred.shape, "no case", dtype=object)
+    status[in_range] = "ok"
+    status[in_range & (dpred == -999)] = "no crossing"
+    status[upper] = "upper than range"
+    status[lower] = "lower than range"
+    if not extrapolate:
+        return dpred, case, status
+
+    for mask, start, failed in [
+        (upper, np.nanmin, 0),
+        (lower, np.nanmax, -997),
+    ]:
+        for pos in np.flatnonzero(mask.any(axis=0)):
+            rows = np.flatnonzero(mask[:, pos])
+            x, y = matrix.plot_curve(pos)
+            preds = spline_roots(x, y, thresholds[rows], int(start(x)))
+            _fill_failed(dpred[:, pos], status[:, pos], rows, preds, failed)
+
+    return dpred, case, status
+
+
+def spline_crossings(curves, guesses, threshold, grid):
+    """Days where the smoothing splines of some plots reach the threshold.
+
+    The splines are evaluated on a shared grid of days, the crossings are
+    located by the sign changes and the one nearest to the initial guess
+    is refined inside its interval. Plots without a sign change in the
+    grid fall back to the root search of spline_root.
+
+    Parameters
+    ----------
+    curves :list
+        list with the days and values of each plot.
+    guesses :list
+        initial guess of each plot.
+    threshold :float
+        value to reach.
+    grid :np.array
+        days where the splines are evaluated.
+
+    Returns
+    -------
+        list with the rounded day of each plot, None when the search of
+        a plot fails.
+    """
+    splines = [UnivariateSpline(x, y, k=3, s=4) for x, y in curves]
+    if not splines:
+        return []
+    diff = np.stack([spl(grid) for spl in splines]) - threshold
+    f0, f1 = diff[:, :-1], diff[:, 1:]
+    change = np.signbit(f0) != np.signbit(f1)
+    # Linear estimate of each crossing, to find the nearest to the guess.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cross = grid[:-1] + f0 * (grid[1:] - grid[:-1]) / (f0 - f1)
+    dist = np.where(
+        change,
+        np.abs(cross - np.asarray(guesses, dtype=float)[:, None]),
+        np.inf,
+    )
+    nearest = dist.argmin(axis=1)
+
+    preds = []
+    for pos, spl in enumerate(splines):
+        i = nearest[pos]
+        if change[pos, i]:
+            day = brentq(
+                lambda x_val: spl(x_val) - threshold, grid[i], grid[i + 1]
+            )
+            preds.append(round(day))
+        else:
+            x, y = curves[pos]
+            preds.append(spline_root(x, y, threshold, guesses[pos]))
+    return preds
+
+
+def spline_estimation(matrix, threshold, grid_size=2048, day_range=None):
+    """Predicts the day of senescence of every plot with splines.
+
+    Parameters
+    ----------
+    matrix :CurveMatrix
+        days and values of the plots.
+    threshold :float
+        value to determine if a plot is dry or not.
+    grid_size :int
+        number of days of the shared grid, which spans the observed days.
+        Crossings outside it are searched from the initial guess.
+    day_range :tuple
+        first and last day of the grid. By default the observed days of
+        the matrix, CurveData passes the days of all the plots so the
+        chunks share the grid.
+
+    Returns
+    -------
+        tuple with the predicted day, the case ("IN", "upper" or "lower")
+        and the status of each plot. Plots that match no case get NaN.
+    """
+    in_range, upper, lower = threshold_cases(matrix, threshold)
+    n_plots = len(matrix.ids)
+    guesses = np.zeros(n_plots)
+    failed = np.zeros(n_plots)
+
+    # The guess of the plots in range is the interpolated crossing.
+    crossing = threshold_crossing(matrix.days, matrix.values, threshold)
+    guesses[in_range] = np.where(crossing == -999, -900, crossing)[in_range]
+    first_day = np.nanmin(matrix.days, axis=1, initial=np.inf)
+    last_day = np.nanmax(matrix.days, axis=1, initial=-np.inf)
+    guesses[upper] = first_day[upper]
+    guesses[lower] = last_day[lower]
+    failed[lower] = -997
+
+    dpred = np.full(n_plots, np.nan)
+    case = np.full(n_plots, np.nan, dtype=object)
+    case[in_range] = "IN"
+    case[upper] = "upper"
+    case[lower] = "lower"
+    status = _case_status(case, upper, lower)
+
+    todo = np.flatnonzero(in_range | upper | lower)
+    if not len(todo):
+        return dpred, case, status
+
+    if day_range is None:
+        day_range = (first_day[todo].min(), last_day[todo].max())
+    grid = np.linspace(*day_range, grid_size)
+
+    preds = spline_crossings(
+        [matrix.plot_curve(pos) for pos in todo],
+        guesses[todo].astype(int).tolist(),
+        threshold,
+        grid,
+    )
+    _fill_failed(dpred, status, todo, preds, failed[todo])
+    return dpred, case, status
+
+
+def loess_weights(x, frac):
+    """Tricube weights of the local regressions of a vector of days.
+
+    Follows the neighborhoods of statsmodels lowess, the k = frac * n
+    nearest days of each day.
+
+    Parameters
+    ----------
+    x :np.array
+        sorted days.
+    frac :float
+        fraction of the days used in each local regression.
+
+    Returns
+    -------
+        (n x n) matrix, row i has the weights of the regression at x[i].
+    """
+    n = len(x)
+    k = min(max(int(frac * n + 1e-10), 2), n)
+    weights = np.zeros((n, n))
+    left, right = 0, k
+    for i, xval in enumerate(x):
+        while right < n and xval > (x[left] + x[right]) / 2.0:
+            left += 1
+            right += 1
+        radius = max(xval - x[left], x[right - 1] - xval)
+        dist = np.abs(x[left:right] - xval) / radius
+        tri = 1.0 - dist * dist * dist
+        weights[i, left:right] = tri * tri * tri
+    return weights
+
+
+def _loess_fit(x, y, weights):
+    """Local linear fits of the rows of y with the given weights.
+
+    Parameters
+    ----------
+    x :np.array
+        sorted days, shape (n,).
+    y :np.array
+        values, shape (plots, n).
+    weights :np.array
+        weights of each regression, shape (n, n) shared by all the plots
+        or (plots, n, n).
+
+    Returns
+    -------
+        fitted values, shape (plots, n).
+    """
+    reg_ok = np.count_nonzero(weights > 1e-12, axis=-1) >= 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w = weights / weights.sum(axis=-1, keepdims=True)
+    mean_x = w @ x
+    dev = x - mean_x[..., None]
+    sqdev = np.fmax((w * dev**2).sum(axis=-1), 1e-12)
+    operator = w * (1.0 + (x - mean_x)[..., None] * dev / sqdev[..., None])
+    if operator.ndim == 2:
+        # The same regressions for every plot, a single product.
+        fit = y @ operator.T
+    else:
+        fit = np.einsum("pij,pj->pi", operator, y)
+    return np.where(reg_ok, fit, y)
+
+
+def _residual_weights(y, fit):
+    """Bisquare robustness weights of the residuals of each row."""
+    resid = np.abs(y - fit)
+    median = np.median(resid, axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std_resid = np.where(
+            median == 0, (resid > 0).astype(float), resid / (6.0 * median)
+        )
+    std_resid = np.minimum(std_resid, 1.0)
+    return (1.0 - std_resid**2) ** 2
+
+
+def loess_smooth(x, y, frac, it=3):
+    """Smooths many curves that share the days with LOESS.
+
+    Gives the fitted values of statsmodels lowess(y, x, frac, it) for each
+    row of y, up to floating point rounding. The first fit of all the rows
+    is a single matrix product, the robust iterations reweight the shared
+    tricube weights.
+
+    Parameters
+    ----------
+    x :np.array
+        sorted days, shape (n,).
+    y :np.array
+        values, shape (plots, n).
+    frac :float
+        fraction of the days used in each local regression.
+    it :int
+        number of robust iterations.
+
+    Returns
+    -------
+        fitted values, shape (plots, n).
+    """
+    weights = loess_weights(x, frac)
+    fit = _loess_fit(x, y, weights)
+    for _ in range(it):
+        robust = _residual_weights(y, fit)
+        fit = _loess_fit(x, y, weights * robust[:, None, :])
+    return fit
+
+
+def inverse_interp(x, y, value):
+    """Day where each curve reaches a value, interpolating x from y.
+
+    Equals scipy interp1d(y, x, fill_value="extrapolate")(value) applied
+    to each row.
+
+    Parameters
+    ----------
+    x :np.array
+        days, shape (n,).
+    y :np.array
+        values, shape (plots, n).
+    value :float
+        value to reach.
+
+    Returns
+    -------
+        np.array with the day of each row.
+    """
+    order = np.argsort(y, axis=1, kind="mergesort")
+    ys = np.take_along_axis(y, order, axis=1)
+    xs = x[order]
+    hi = np.clip(np.count_nonzero(ys < value, axis=1), 1, len(x) - 1)
+    rows = np.arange(len(y))
+    x_lo, x_hi = ys[rows, hi - 1], ys[rows, hi]
+    y_lo, y_hi = xs[rows, hi - 1], xs[rows, hi]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (y_hi - y_lo) / (x_hi - x_lo)
+    return slope * (value - x_lo) + y_lo
+
+
+def loess_estimation(matrix, threshold, frac=0.5, it=3):
+    """Predicts the day of senescence of every plot with LOESS.
+
+    The plots are grouped by their vector of days, and the plots of each
+    group are smoothed together.
+
+    Parameters
+    ----------
+    matrix :CurveMatrix
+        days and values of the plots.
+    threshold :float
+        value to determine if a plot is dry or not.
+    frac :float
+        fraction of the days used in each local regression.
+    it :int
+        number of robust iterations.
+
+    Returns
+    -------
+        tuple with the predicted day, the case ("IN", "upper" or "lower")
+        and the status of each plot. Plots that match no case get NaN.
+    """
+    in_range, upper, lower = threshold_cases(matrix, threshold)
+    dpred = np.full(len(matrix.ids), np.nan)
+    case = np.full(len(matrix.ids), np.nan, dtype=object)
+    case[in_range] = "IN"
+    case[upper] = "upper"
+    case[lower] = "lower"
+
+    todo = np.flatnonzero(in_range | upper | lower)
+    groups = pd.Series(todo).groupby(
+        [matrix.days[todo, i] for i in range(matrix.days.shape[1])],
+        dropna=False,
+    )
+    for _, rows in groups:
+        rows = rows.to_numpy()
+        x, _ = matrix.plot_curve(rows[0])
+        y = matrix.values[rows, : len(x)]
+        fit = loess_smooth(x, y, frac, it)
+        dpred[rows] = np.round(inverse_interp(x, fit, threshold))
+
+    status = _case_status(case, upper, lower)
+    status[(case == "IN") & np.isnan(dpred)] = "no crossing"
+    return dpred, case, status
+
+
+_MODELS = {
+    "threshold": threshold_estimation,
+    "splines": spline_estimation,
+    "loess": loess_estimation,
+}
+
+
+def _predict_chunk(matrix, model, threshold, kwargs):
+    """Runs a model on a chunk of plots, in a worker process or not."""
+    return _MODELS[model](matrix, threshold, **kwargs)
@@ -0,0 +1,355 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: MIT
+# Copyright (c) 2024, Fiore J.Manuel.
+# All rights reserved.
+
+"""Provides the storage profiles used to write the plot arrays."""
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+import attrs
+
+import numpy as np
+import pandas as pd
+import zarr
+from numcodecs import Blosc, FixedScaleOffset
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+RAGGED_CHUNK = 2**20
+
+_SHUFFLES = {
+    "noshuffle": Blosc.NOSHUFFLE,
+    "shuffle": Blosc.SHUFFLE,
+    "bitshuffle": Blosc.BITSHUFFLE,
+}
+
+
+@attrs.define(frozen=True)
+class StorageProfile:
+    """Codec, dtype and chunking used to write the plot arrays.
+
+    Parameters
+    ----------
+    cname :str
+        Blosc compressor, "lz4", "lz4hc", "zstd", "zlib" or "blosclz".
+        "none" writes the arrays uncompressed.
+    clevel :int
+        compression level from 0 to 9.
+    shuffle :str
+        "noshuffle", "shuffle" or "bitshuffle".
+    float_dtype :str
+        dtype for the floating point arrays, for example "float32" or
+        "uint16". None keeps the dtype of the raster.
+    scale :float
+        factor applied before storing the floats as an integer
+        float_dtype, for example 10000 keeps 4 decimals of a 0-1
+        reflectance in "uint16". The arrays are read back as floats.
+        Required with an integer float_dtype.
+    chunks :tuple or bool
+        chunk shape of the arrays. True lets zarr choose it, False writes
+        each array as a single chunk. The 1-D band arrays of the ragged
+        layout get a chunk with the same number of elements, or of
+        RAGGED_CHUNK elements with False, as a single chunk would hold
+        all the plots of the date.
+    """
+
+    cname: str = "lz4"
+    clevel: int = 5
+    shuffle: str = "shuffle"
+    float_dtype: str = None
+    scale: float = None
+    chunks: object = True
+
+    def __attrs_post_init__(self):
+        """Checks that an integer float_dtype has a scale."""
+        if self._scaled and self.scale is None:
+            raise ValueError(
+                f"float_dtype {self.float_dtype!r} is an integer dtype, "
+                "give the scale that maps the floats to it"
+            )
+
+    @property
+    def _scaled(self):
+        """The floats are stored as integers."""
+        return (
+            self.float_dtype is not None
+            and np.dtype(self.float_dtype).kind in "iu"
+        )
+
+    @property
+    def compressor(self):
+        """Numcodecs compressor of the profile."""
+        if self.cname == "none":
+            return None
+        return Blosc(
+            cname=self.cname,
+            clevel=self.clevel,
+            shuffle=_SHUFFLES[self.shuffle],
+        )
+
+    def cast(self, arr):
+        """Casts a floating point array to the dtype of the profile.
+
+        With an integer float_dtype the values are clipped to the range
+        it can store and kept as floats, the filters of the array scale
+        and round them.
+
+        Parameters
+        ----------
+        arr :np.array
+            array to cast.
+
+        Returns
+        -------
+            np.array
+        """
+        arr = np.asarray(arr)
+        if self.float_dtype is None or arr.dtype.kind != "f":
+            return arr
+        if self._scaled:
+            info = np.iinfo(self.float_dtype)
+            return np.clip(arr, info.min / self.scale, info.max / self.scale)
+        return arr.astype(self.float_dtype)
+
+    def filters(self, dtype):
+        """Filters of the zarr arrays of the given dtype."""
+        if not self._scaled or np.dtype(dtype).kind != "f":
+            return None
+        return [
+            FixedScaleOffset(
+                offset=0,
+                scale=self.scale,
+                dtype=np.dtype(dtype).str,
+                astype=np.dtype(self.float_dtype).str,
+            )
+        ]
+
+    def chunks_for(self, ndim, chunks=None):
+        """Chunk shape of an array with ndim dimensions.
+
+        Parameters
+        ----------
+        ndim :int
+            number of dimensions of the array.
+        chunks :tuple
+            chunk shape used when the profile lets zarr choose it.
+
+        Returns
+        -------
+            tuple or bool
+        """
+        if self.chunks is True and chunks is not None:
+            arr_chunks = chunks
+        else:
+            arr_chunks = self.chunks
+        if arr_chunks is False and ndim == 1:
+            return (RAGGED_CHUNK,)
+        if isinstance(arr_chunks, bool):
+            return arr_chunks
+        arr_chunks = tuple(int(c) for c in arr_chunks)
+        if len(arr_chunks) > ndim:
+            # The plot tiles become runs of pixels of the flattened plots.
+            tail = int(np.prod(arr_chunks[ndim - 1 :]))
+            arr_chunks = arr_chunks[: ndim - 1] + (tail,)
+        return arr_chunks
+
+    def write(self, group, name, arr, chunks=None):
+        """Writes an array into a group with the profile.
+
+        Parameters
+        ----------
+        group :zarr.Group
+            group where the array is written.
+        name :str
+            name of the array.
+        arr :np.array
+            values of the array.
+        chunks :tuple
+            chunk shape used when the profile lets zarr choose it.
+
+        Returns
+        -------
+            zarr.Array
+        """
+        arr = self.cast(arr)
+        return group.array(
+            name,
+            arr,
+            chunks=self.chunks_for(arr.ndim, chunks),
+            compressor=self.compressor,
+            filters=self.filters(arr.dtype),
+            overwrite=True,
+        )
+
+
+STORAGE_PROFILES = {
+    "default": StorageProfile(),
+    "fast": StorageProfile(cname="lz4", clevel=1, chunks=False),
+    "compact": StorageProfile(
+        cname="zstd", clevel=7, shuffle="bitshuffle", chunks=False
+    ),
+    "compact_float32": StorageProfile(
+        cname="zstd",
+        clevel=7,
+        shuffle="bitshuffle",
+        float_dtype="float32",
+        chunks=False,
+    ),
+}
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def get_profile(storage=None):
+    """Returns a storage profile.
+
+    Parameters
+    ----------
+    storage :str or StorageProfile
+        name of a profile in STORAGE_PROFILES or a profile. None returns
+        the default profile.
+
+    Returns
+    -------
+        StorageProfile
+    """
+    if storage is None:
+        return STORAGE_PROFILES["default"]
+    if isinstance(storage, StorageProfile):
+        return storage
+    try:
+        return STORAGE_PROFILES[storage]
+    except KeyError:
+        raise ValueError(
+            f"Unknown storage profile {storage!r}, "
+            f"use one of {list(STORAGE_PROFILES)}"
+        )
+
+
+def bump_revision(group):
+    """Marks the arrays of a date group as changed.
+
+    The caches computed from the arrays, like the hue histograms, keep the
+    revision they were computed from and are recomputed when it changes.
+
+    Parameters
+    ----------
+    group :zarr.Group
+        date group that was written.
+    """
+    group.attrs["revision"] = uuid.uuid4().hex
+    return
+
+
+def copy_with_profile(source, dest, storage=None):
+    """Copies a zarr group rewriting its arrays with a storage profile.
+
+    Parameters
+    ----------
+    source :zarr.Group
+        group to copy.
+    dest :zarr.Group
+        group where the arrays are written.
+    storage :str or StorageProfile
+        profile used to write the arrays.
+    """
+    profile = get_profile(storage)
+    dest.attrs.update(source.attrs.asdict())
+    for name, arr in source.arrays():
+        profile.write(dest, name, arr[:], chunks=arr.chunks)
+        dest[name].attrs.update(arr.attrs.asdict())
+    for name, group in source.groups():
+        copy_with_profile(group, dest.require_group(name), profile)
+    return
+
+
+def _read_all(group):
+    """Reads every array of a group and returns the uncompressed bytes."""
+    nbytes = 0
+    for _, arr in group.arrays():
+        nbytes += arr[:].nbytes
+    for _, sub in group.groups():
+        nbytes += _read_all(sub)
+    return nbytes
+
+
+def _dir_size(path):
+    """Size in bytes of the files of a directory."""
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def benchmark_storage_profiles(project, profiles=None, tmp_dir=None):
+    """Measures the size and speed of the raw data with each profile.
+
+    Parameters
+    ----------
+    project :Pynomicproject
+        project with the raw data to write.
+    profiles :dict
+        dict with the name and profile to measure. By default all the
+        STORAGE_PROFILES.
+    tmp_dir :str
+        directory where the temporary stores are written.
+
+    Returns
+    -------
+        DataFrame with the bytes on disk, write seconds, read seconds and
+        read throughput (MB/s of uncompressed data) of each profile.
+    """
+    if profiles is None:
+        profiles = STORAGE_PROFILES
+
+    rows = []
+    for name, profile in profiles.items():
+        path = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            dest = zarr.open_group(zarr.DirectoryStore(path), mode="w")
+            start = time.perf_counter()
+            copy_with_profile(project.raw_data, dest, profile)
+            write_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+            nbytes = _read_all(zarr.open_group(path, mode="r"))
+            read_s = time.perf_counter() - start
+
+            rows.append(
+                [
+                    name,
+                    _dir_size(path),
+                    nbytes,
+                    write_s,
+                    read_s,
+                    nbytes / 2**20 / read_s,
+                ]
+            )
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "profile",
+            "bytes_on_disk",
+            "bytes_raw",
+            "write_s",
+            "read_s",
+            "read_mb_s",
+        ],
+    )
@@ -9,15 +9,27 @@
 # =============================================================================
 # IMPORTS
 # =============================================================================
+import attrs
 import numpy as np
 import pandas as pd
 import rasterio
 import cv2
 import os
+import threading
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import json
 from shapely.geometry import MultiPolygon, Polygon
 from rasterio import mask
+from rasterio.features import geometry_mask, geometry_window
 from Pynomic.core import core
+from Pynomic.core.storage import (
+    RAGGED_CHUNK,
+    StorageProfile,
+    bump_revision,
+    get_profile,
+)
 import re
 from PIL import Image
 import zarr
@@ -26,6 +38,282 @@ import pandas_geojson as pdg
 import geopandas as gdp
 import shapely
 
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+
+@attrs.define
+class BlockCache:
+    """LRU cache of decoded raster blocks shared by the plots of a flight.
+
+    Blocks are keyed by dataset path and block index, so each compressed
+    block is decoded once while it stays in the cache.
+
+    Parameters
+    ----------
+    max_bytes :int
+        maximum size of the cached blocks. The least recently used blocks
+        are evicted once it is exceeded.
+    """
+
+    max_bytes: int = 256 * 2**20
+    hits: int = attrs.field(default=0, init=False)
+    misses: int = attrs.field(default=0, init=False)
+    nbytes: int = attrs.field(default=0, init=False)
+    _blocks: OrderedDict = attrs.field(factory=OrderedDict, init=False)
+    _lock: threading.Lock = attrs.field(factory=threading.Lock, init=False)
+
+    def __len__(self):
+        """Number of cached blocks."""
+        return len(self._blocks)
+
+    def clear(self):
+        """Removes all the cached blocks."""
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes = 0
+
+    def get_block(self, src, block_row, block_col):
+        """Returns a decoded block of the raster.
+
+        Parameters
+        ----------
+        src :rasterio.DatasetReader
+            open raster dataset.
+        block_row :int
+            row index of the block.
+        block_col :int
+            column index of the block.
+
+        Returns
+        -------
+            window of the block, array with the bands and array with the
+            masks (0 is not valid).
+        """
+        key = (src.name, block_row, block_col)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+
+        block_window = src.block_window(1, block_row, block_col)
+        block = (
+            block_window,
+            src.read(window=block_window),
+            src.read_masks(window=block_window),
+        )
+        size = block[1].nbytes + block[2].nbytes
+        with self._lock:
+            if key not in self._blocks:
+                self._blocks[key] = block
+                self.nbytes += size
+            while self.nbytes > self.max_bytes and len(self._blocks) > 1:
+                _, (_, data, valid) = self._blocks.popitem(last=False)
+                self.nbytes -= data.nbytes + valid.nbytes
+        return block
+
+    def read_window(self, src, window):
+        """Reads a window assembling it from the cached blocks.
+
+        Parameters
+        ----------
+        src :rasterio.DatasetReader
+            open raster dataset.
+        window :rasterio.windows.Window
+            pixel window to read, inside the dataset.
+
+        Returns
+        -------
+            array with the bands and array with the masks (0 is not valid).
+        """
+        row0, col0 = int(window.row_off), int(window.col_off)
+        row1, col1 = row0 + int(window.height), col0 + int(window.width)
+        block_h, block_w = src.block_shapes[0]
+
+        data = np.zeros((src.count, row1 - row0, col1 - col0), src.dtypes[0])
+        valid = np.zeros(data.shape, np.uint8)
+        for block_row in range(row0 // block_h, (row1 - 1) // block_h + 1):
+            for block_col in range(col0 // block_w, (col1 - 1) // block_w + 1):
+                bwin, bdata, bvalid = self.get_block(src, block_row, block_col)
+                brow0, bcol0 = int(bwin.row_off), int(bwin.col_off)
+                # Overlap between the block and the window.
+                r0, r1 = max(row0, brow0), min(row1, brow0 + bwin.height)
+                c0, c1 = max(col0, bcol0), min(col1, bcol0 + bwin.width)
+                data[:, r0 - row0 : r1 - row0, c0 - col0 : c1 - col0] = bdata[
+                    :, r0 - brow0 : r1 - brow0, c0 - bcol0 : c1 - bcol0
+                ]
+                valid[:, r0 - row0 : r1 - row0, c0 - col0 : c1 - col0] = (
+                    bvalid[:, r0 - brow0 : r1 - brow0, c0 - bcol0 : c1 - bcol0]
+                )
+        return data, valid
+
+
+@attrs.define
+class PlotGrid:
+    """Parsed plot grid shared by all the flights of a stack.
+
+    Parameters
+    ----------
+    geodf :geopandas.GeoDataFrame
+        grid with the id column as str.
+    col_id :str
+        unique column name identifier from the grid.
+    ids :list
+        id of each plot.
+    geometries :list
+        geometry of each plot in the crs of the grid.
+    bounds :np.array
+        (n_plots, 4) array with minx, miny, maxx, maxy of each plot.
+    """
+
+    geodf: gdp.GeoDataFrame
+    col_id: str
+    ids: list
+    geometries: list
+    bounds: np.ndarray
+    _projected: dict = attrs.field(factory=dict, init=False, repr=False)
+
+    @classmethod
+    def from_file(cls, gpath, col_id: str):
+        """Reads a geojson or shape file.
+
+        Parameters
+        ----------
+        gpath :str
+            grid path to a geojson or shape file.
+        col_id :str
+            unique column name identifier from the grid.
+
+        Returns
+        -------
+            PlotGrid object.
+        """
+        geodf, poligons_dict = _read_grid2(gpath, col_id)
+        geometries = list(poligons_dict.values())
+        return cls(
+            geodf=geodf,
+            col_id=col_id,
+            ids=list(poligons_dict.keys()),
+            geometries=geometries,
+            bounds=shapely.bounds(np.array(geometries, dtype=object)),
+        )
+
+    @property
+    def crs(self):
+        """Coordinate system of the grid."""
+        return self.geodf.crs
+
+    def geometries_for(self, crs=None):
+        """Returns the plot geometries in a coordinate system.
+
+        The reprojections are cached, so each crs is computed once.
+
+        Parameters
+        ----------
+        crs :rasterio.crs.CRS or str
+            target coordinate system. None or the crs of the grid returns
+            the original geometries.
+
+        Returns
+        -------
+            list with the geometry of each plot.
+        """
+        if crs is None or self.crs is None or self.crs == crs:
+            return self.geometries
+        key = str(crs)
+        if key not in self._projected:
+            self._projected[key] = list(
+                gdp.GeoSeries(self.geometries, crs=self.crs).to_crs(crs)
+            )
+        return self._projected[key]
+
+
+_GRID_CACHE = {}
+
+
+@attrs.define
+class _GroupWriter:
+    """Writes each plot as a group with one array per band."""
+
+    date_group: zarr.Group
+    profile: StorageProfile = attrs.field(factory=StorageProfile)
+
+    def write(self, plot_key, bands):
+        """Writes the bands arrays of a plot."""
+        plot_group = self.date_group.create_group(plot_key)
+        for band, arr in bands.items():
+            self.profile.write(plot_group, band, arr)
+
+    def close(self):
+        """Nothing is buffered, marks the date as changed."""
+        bump_revision(self.date_group)
+
+
+@attrs.define
+class _RaggedWriter:
+    """Writes the plots of a date as one concatenated array per band.
+
+    The flattened plots are buffered and appended to the band arrays, and
+    the "index" array keeps the offset, height and width of each plot.
+    """
+
+    date_group: zarr.Group
+    profile: StorageProfile = attrs.field(factory=StorageProfile)
+    flush_bytes: int = 64 * 2**20
+    _plots: list = attrs.field(factory=list, init=False)
+    _buffer: dict = attrs.field(factory=dict, init=False)
+    _index: list = attrs.field(factory=list, init=False)
+    _offset: int = attrs.field(default=0, init=False)
+    _nbytes: int = attrs.field(default=0, init=False)
+
+    def write(self, plot_key, bands):
+        """Buffers the bands arrays of a plot."""
+        shape = next(iter(bands.values())).shape
+        self._plots.append(plot_key)
+        self._index.append([self._offset, shape[0], shape[1]])
+        self._offset += shape[0] * shape[1]
+        for band, arr in bands.items():
+            self._buffer.setdefault(band, []).append(arr.ravel())
+            self._nbytes += arr.nbytes
+        if self._nbytes >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered plots to the band arrays."""
+        if not self._index:
+            return
+        index = np.array(self._index, dtype=np.int64)
+        if "index" in self.date_group:
+            self.date_group["index"].append(index)
+        else:
+            self.date_group.array("index", index, chunks=(4096, 3))
+        for band, arrs in self._buffer.items():
+            data = np.concatenate(arrs)
+            if band in self.date_group:
+                self.date_group[band].append(self.profile.cast(data))
+            else:
+                # Appending needs a fixed chunk size.
+                self.profile.write(
+                    self.date_group, band, data, (RAGGED_CHUNK,)
+                )
+        self._buffer = {}
+        self._index = []
+        self._nbytes = 0
+
+    def close(self):
+        """Flushes the buffer and writes the layout attributes."""
+        self.flush()
+        self.date_group.attrs.update(layout="ragged", plots=self._plots)
+        bump_revision(self.date_group)
+
+
+_WRITERS = {"groups": _GroupWriter, "ragged": _RaggedWriter}
+
+
 # =============================================================================
 # FUNCTIONS
 # =============================================================================
@@ -97,6 +385,32 @@ def _read_grids(gpath, col_id: str):
     data_dic = data.loc[:, [col_id, "geometry"]].copy().to_dict(index=False)
 
 
+def load_grid(gpath, col_id: str):
+    """Returns the parsed grid of a file, reading it only once.
+
+    The grid is cached by path and modification time, so it is parsed
+    again only if the file changes.
+
+    Parameters
+    ----------
+        gpath:str
+            grid path to a geojson or shape file.
+        col_id:str
+            unique column name identifier from the grid.
+
+    Returns
+    -------
+        PlotGrid object.
+    """
+    key = (os.path.abspath(gpath), col_id)
+    mtime = os.path.getmtime(gpath)
+    cached = _GRID_CACHE.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, PlotGrid.from_file(gpath, col_id))
+        _GRID_CACHE[key] = cached
+    return cached[1]
+
+
 def _get_dataframe_from_json(path_gjson):
     data = pdg.read_geojson(path_gjson)
     collist = data.get_properties()
@@ -129,7 +443,8 @@ def _get_tiff_files(fold_path):
         if os.path.basename(file).split(".", 1)[1] == "tif":
             tiff_list.append(file)
 
-    return tiff_list
+    # Flights are named by date, so sorting gives a date ordered stack.
+    return sorted(tiff_list)
 
 
 def auto_fit_image(mtx, hbuffer=2, wbuffer=2):
@@ -179,6 +494,168 @@ def auto_fit_image(mtx, hbuffer=2, wbuffer=2):
     return (h1, h2, w1, w2), angle
 
 
+def _long_side_angle(geom, transform):
+    """Returns the doubled angle of the long side of a plot, in radians.
+
+    The angle is measured as seen in the image, where the rows go down.
+    """
+    rect = np.array(geom.minimum_rotated_rectangle.exterior.coords)[:4]
+    cols, rows = ~transform * (rect[:, 0], rect[:, 1])
+    edges = np.diff(np.column_stack([cols, rows]), axis=0)[:2]
+    dcol, drow = edges[np.argmax(np.hypot(edges[:, 0], edges[:, 1]))]
+    return 2 * np.arctan2(-drow, dcol)
+
+
+def _to_fit_angle(doubled):
+    """Converts doubled long side angles to the auto_fit_image angle."""
+    # Mean of the doubled angles, the sides have no direction.
+    side = np.arctan2(np.mean(np.sin(doubled)), np.mean(np.cos(doubled))) / 2
+    angle = 90 - np.degrees(side)
+    return float((angle + 90) % 180 - 90)
+
+
+def grid_rotation_angle(plot_geoms, transform):
+    """Estimates the rotation of the grid from the plots geometry.
+
+    The angle is the one that leaves the long side of the plots vertical,
+    in the same convention as auto_fit_image.
+
+    Parameters
+    ----------
+        plot_geoms:list
+            geometries of the plots.
+        transform:affine.Affine
+            affine transform of the raster.
+
+    Returns
+    -------
+        Angle value.
+    """
+    return _to_fit_angle(
+        [_long_side_angle(geom, transform) for geom in plot_geoms]
+    )
+
+
+def geometry_fit_params(plot_geom, transform, shape, hbuffer=2, wbuffer=2):
+    """Takes a plot geometry and returns the crooping and angle parameters.
+
+    Same parameters as auto_fit_image, derived from the minimum rotated
+    rectangle of the polygon instead of the pixels of the image.
+
+    Parameters
+    ----------
+        plot_geom:Polygon or MultiPolygon
+            geometry of the plot.
+        transform:affine.Affine
+            affine transform of the extracted plot image.
+        shape:tuple
+            (height, width) of the extracted plot image.
+        hbuffer:int
+            height buffer
+        wbuffer:int
+            with buffer
+
+    Returns
+    -------
+        tuple with croping parameters. Angle value.
+    """
+    angle = _to_fit_angle([_long_side_angle(plot_geom, transform)])
+
+    h, w = shape
+    rect = np.array(plot_geom.minimum_rotated_rectangle.exterior.coords)[:4]
+    cols, rows = ~transform * (rect[:, 0], rect[:, 1])
+
+    # Rotate the corners as PIL rotate(angle, expand=True) does.
+    (new_h, new_w), cos, sin = _expanded_shape(shape, angle)
+    x_rot = new_w / 2 + (cols - w / 2) * cos + (rows - h / 2) * sin
+    y_rot = new_h / 2 - (cols - w / 2) * sin + (rows - h / 2) * cos
+
+    # Pixels with the center inside the rotated rectangle.
+    x = int(np.ceil(x_rot.min() - 0.5))
+    y = int(np.ceil(y_rot.min() - 0.5))
+    w = int(np.floor(x_rot.max() - 0.5)) - x + 1
+    h = int(np.floor(y_rot.max() - 0.5)) - y + 1
+
+    h1 = max(y + hbuffer, 0)
+    h2 = y + (h - hbuffer)
+    w1 = max(x + wbuffer, 0)
+    w2 = x + (w - wbuffer)
+    return (h1, h2, w1, w2), angle
+
+
+def _expanded_shape(shape, angle):
+    """Shape of an image rotated as PIL rotate(angle, expand=True) does.
+
+    Returns
+    -------
+        (height, width) of the rotated image, cosine and sine of the angle.
+    """
+    h, w = shape
+    cos = round(np.cos(np.radians(angle % 360)), 15)
+    sin = round(np.sin(np.radians(angle % 360)), 15)
+    corners = np.array([[0, 0], [w, 0], [w, h], [0, h]]) - (w / 2, h / 2)
+    xx = w / 2 + corners[:, 0] * cos + corners[:, 1] * sin
+    yy = h / 2 - corners[:, 0] * sin + corners[:, 1] * cos
+    new_w = int(np.ceil(xx.max()) - np.floor(xx.min()))
+    new_h = int(np.ceil(yy.max()) - np.floor(yy.min()))
+    return (new_h, new_w), cos, sin
+
+
+def rotate_bands(bands, angle):
+    """Rotates all the bands with affine warps of up to 4 bands.
+
+    Same as rotating each band with PIL rotate(angle, expand=True).
+    OpenCV only follows that sampling for 1, 3 and 4 channels, so the
+    bands are warped in groups of 4 and a last pair is padded to 3.
+
+    Parameters
+    ----------
+        bands:list
+            list with the array of each band.
+        angle:float
+            counter clockwise angle in degrees.
+
+    Returns
+    -------
+        list with the rotated bands.
+    """
+    stack = np.dstack(bands)
+    if angle % 90 == 0:
+        # Exact rotation, as the PIL fast path.
+        rotated = np.rot90(stack, int(angle % 360) // 90)
+        return [rotated[:, :, i].copy() for i in range(rotated.shape[2])]
+
+    dtype = stack.dtype
+    if dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+        stack = stack.astype(np.float64)
+
+    h, w = stack.shape[:2]
+    (new_h, new_w), _, _ = _expanded_shape((h, w), angle)
+
+    # Pixel centers are at integer coordinates in OpenCV.
+    rot = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), angle, 1.0)
+    rot[0, 2] += (new_w - w) / 2
+    rot[1, 2] += (new_h - h) / 2
+
+    rotated = []
+    for start in range(0, stack.shape[2], 4):
+        group = stack[:, :, start : start + 4]
+        n_bands = group.shape[2]
+        if n_bands == 2:
+            group = np.dstack([group, np.zeros_like(group[:, :, 0])])
+        warped = cv2.warpAffine(
+            np.ascontiguousarray(group),
+            rot,
+            (new_w, new_h),
+            flags=cv2.INTER_NEAREST,
+            borderValue=0,
+        ).reshape(new_h, new_w, -1)
+        rotated.extend(
+            warped[:, :, i].astype(dtype, copy=False) for i in range(n_bands)
+        )
+    return rotated
+
+
 def _extract_bands_from_raster(raster_data, multiplot, alpha_idx=-1):
     """Separates the bands for the maks.
 
@@ -207,17 +684,282 @@ def _extract_bands_from_raster(raster_data, multiplot, alpha_idx=-1):
     return true_bands, masked_band
 
 
-def extract_raster_data(raster_path, grid_path, col_id: str, bands_n=None):
+def _read_window(src, window, cache=None):
+    """Reads the bands and the validity masks of a window.
+
+    Parameters
+    ----------
+        src:rasterio.DatasetReader
+            open raster dataset.
+        window:rasterio.windows.Window
+            pixel window to read.
+        cache:BlockCache
+            block cache to read from, None reads the window directly.
+
+    Returns
+    -------
+        array with the bands and array with the masks (0 is not valid).
+    """
+    if cache is not None:
+        return cache.read_window(src, window)
+    data = src.read(window=window)
+    valid = src.read_masks(window=window)
+    return data, valid
+
+
+def _extract_bands_from_window(src, multiplot, alpha_idx=-1, cache=None):
+    """Separates the bands for the mask reading only the plot window.
+
+    Gives the same arrays as _extract_bands_from_raster, but the polygon
+    is rasterized over the window of its bounds instead of the dataset.
+
+    Parameters
+    ----------
+        src:rasterio.DatasetReader
+            open raster dataset.
+        multiplot:Multiplot
+            a multiplot obj form sapely.
+        alpha_idx:int
+            position of the alpha band, -1 if the raster has none.
+        cache:BlockCache
+            block cache used for the reads.
+
+    Returns
+    -------
+        list with the bands array and an array from the mask.
+    """
+    window = geometry_window(src, multiplot.geoms)
+    out_shape = (int(window.height), int(window.width))
+    shape_mask = geometry_mask(
+        multiplot.geoms,
+        transform=src.window_transform(window),
+        out_shape=out_shape,
+    )
+    data, valid = _read_window(src, window, cache)
+    nodata = src.nodata if src.nodata is not None else 0
+    masked_rast = np.where((valid == 0) | shape_mask, nodata, data).astype(
+        data.dtype
+    )
+
+    if alpha_idx == -1:
+        true_bands = masked_rast.copy()
+        masked_band = masked_rast[-1]
+    else:
+        true_bands = list(masked_rast)
+        masked_band = true_bands.pop(alpha_idx)
+
+    return true_bands, masked_band
+
+
+def _block_order(src, plot_geoms):
+    """Orders the plots following the internal block layout of the raster.
+
+    Parameters
+    ----------
+        src:rasterio.DatasetReader
+            open raster dataset.
+        plot_geoms:list
+            geometries of the plots.
+
+    Returns
+    -------
+        list with the positions of the plots sorted by block.
+    """
+    block_h, block_w = src.block_shapes[0]
+    keys = []
+    for geom in plot_geoms:
+        minx, miny, maxx, maxy = geom.bounds
+        row, col = src.index(minx, maxy)
+        keys.append((row // block_h, col // block_w, row, col))
+    return sorted(range(len(plot_geoms)), key=keys.__getitem__)
+
+
+def _fit_plot(
+    src,
+    plot_geom,
+    alpha_idx=-1,
+    engine="mask",
+    cache=None,
+    fit="image",
+    angle=None,
+    hbuffer=2,
+    wbuffer=2,
+):
+    """Extracts and fits the bands of a single plot.
+
+    Parameters
+    ----------
+        src:rasterio.DatasetReader
+            open raster dataset.
+        plot_geom:Polygon or MultiPolygon
+            geometry of the plot.
+        alpha_idx:int
+            position of the alpha band, -1 if the raster has none.
+        engine:str
+            "mask" uses rasterio.mask, "window" reads only the plot window.
+        cache:BlockCache
+            block cache used by the "window" engine.
+        fit:str
+            "image" fits each plot with auto_fit_image. "grid" rotates all
+            the bands and the mask at once by the grid angle. "geometry"
+            takes the angle and crop from the plot polygon with
+            geometry_fit_params.
+        angle:float
+            rotation of the grid, used when fit is "grid".
+        hbuffer:int
+            height buffer.
+        wbuffer:int
+            with buffer.
+
+    Returns
+    -------
+        list with the fitted array of each band.
+    """
+    if plot_geom.geom_type == "MultiPolygon":
+        figure = plot_geom
+    else:
+        figure = MultiPolygon([plot_geom])
+
+    if engine == "window":
+        extract_bands = partial(_extract_bands_from_window, cache=cache)
+    else:
+        extract_bands = _extract_bands_from_raster
+
+    if alpha_idx != -1:
+        # Diferentiate the true bands form the mask band.
+        true_bands, masked_band = extract_bands(src, figure, alpha_idx)
+    else:
+        # Returns the las band for fiting.
+        true_bands, masked_band = extract_bands(src, figure)
+
+    if fit == "grid":
+        # One warp for the bands and the mask, the crop is the bounding
+        # box of the rotated mask.
+        *rotated, rotated_mask = rotate_bands(
+            [*true_bands, masked_band], angle
+        )
+        coords = cv2.findNonZero(np.uint8(rotated_mask > 0))
+        x, y, w, h = cv2.boundingRect(coords)
+        return [
+            band[y + hbuffer : y + h - hbuffer, x + wbuffer : x + w - wbuffer]
+            for band in rotated
+        ]
+
+    if fit == "geometry":
+        # Same window and transform that the extraction used.
+        window = geometry_window(src, figure.geoms)
+        cpv, rangle = geometry_fit_params(
+            figure,
+            src.window_transform(window),
+            masked_band.shape,
+            hbuffer,
+            wbuffer,
+        )
+        return [
+            band[cpv[0] : cpv[1], cpv[2] : cpv[3]]
+            for band in rotate_bands(list(true_bands), rangle)
+        ]
+
+    # Get the fitting parameters.
+    cpv, rangle = auto_fit_image(masked_band, hbuffer, wbuffer)
+
+    # Fit the bands array with the parameters.
+    fitted_bands = [
+        np.array(Image.fromarray(band).rotate(rangle, expand=True))[
+            cpv[0] : cpv[1], cpv[2] : cpv[3]
+        ]
+        for band in true_bands
+    ]
+    return fitted_bands
+
+
+def _fit_plot_batch(raster_path, plot_geoms, **fit_kwargs):
+    """Fits a batch of plots with its own handle of the raster.
+
+    Parameters
+    ----------
+        raster_path:str
+            path to raster file.
+        plot_geoms:list
+            geometries of the plots in the batch.
+        fit_kwargs:
+            options given to _fit_plot.
+
+    Returns
+    -------
+        list with the fitted bands of each plot in the batch.
+    """
+    with rasterio.open(raster_path) as src:
+        return [_fit_plot(src, geom, **fit_kwargs) for geom in plot_geoms]
+
+
+def _get_alpha_idx(src):
+    """Returns the position of the alpha band or -1 if there is none."""
+    contains_alpha_band = -1
+    for idx, interp in enumerate(src.colorinterp, start=1):
+        if interp == rasterio.enums.ColorInterp.alpha:
+            contains_alpha_band = idx - 1
+    return contains_alpha_band
+
+
+def extract_raster_data(
+    raster_path,
+    grid_path,
+    col_id: str,
+    bands_n=None,
+    workers=None,
+    chunk_size=256,
+    engine="mask",
+    block_cache=None,
+    fit="image",
+    hbuffer=2,
+    wbuffer=2,
+    out_group=None,
+    layout="groups",
+    storage=None,
+):
     """Extracts the values from the raster file segregating each band and plot.
 
     Parameters
     ----------
         raster_path:str
             path to raster file.
-        grid_path:str
-            path to gird.
+        grid_path:str or PlotGrid
+            path to gird or a grid already parsed with load_grid.
         bands_n:list
             a list of the bands names and order.
+        workers:int
+            number of threads used to extract the plots. Each thread
+            opens its own handle of the raster. None or 1 runs serially.
+        chunk_size:int
+            number of plots given to a thread at a time.
+        engine:str
+            "mask" masks each plot against the dataset with rasterio.mask.
+            "window" reads only the window of each plot, rasterizes the
+            polygon locally and visits the plots in the block order of
+            the raster. Both give the same arrays.
+        block_cache:BlockCache
+            cache of decoded blocks used by the "window" engine. By default
+            a new cache is used for the flight, so every block is decoded
+            once while the plots that touch it are extracted.
+        fit:str
+            "image" finds the angle and crop of each plot from its pixels
+            with auto_fit_image. "grid" estimates the angle once from the
+            grid geometry and rotates all the bands of a plot with a single
+            warp. "geometry" derives the angle and crop of each plot from
+            its polygon and the raster transform, without image analysis.
+        hbuffer:int
+            height buffer removed from the fitted plots.
+        wbuffer:int
+            with buffer removed from the fitted plots.
+        out_group:zarr.Group
+            group of the flight date. When given, the bands of each plot
+            are written into it as soon as they are fitted and the
+            returned dict is empty.
+        layout:str
+            layout used to write into out_group, "groups" or "ragged".
+        storage:str or StorageProfile
+            profile used to write into out_group.
 
     Returns
     -------
@@ -225,79 +967,104 @@ def extract_raster_data(raster_path, grid_path, col_id: str, bands_n=None):
         DataFrame with date, mean band for each plot.
         list bands name.
     """
-    geodf, grids = _read_grid2(grid_path, col_id)
-    bands_mean = []
+    if isinstance(grid_path, PlotGrid):
+        grid = grid_path
+    else:
+        grid = load_grid(grid_path, col_id)
+    geodf = grid.geodf
     array_dict = {}
     bands_name = []
+    plot_keys = grid.ids
     with rasterio.open(raster_path) as src:
-        for pos, g in enumerate(grids.keys()):
-            if int(pos) == 0:
-                coords = src.meta["crs"]
-                print(f"Raster Coords system: {coords}")
-                print(f"Grid Coords system: {geodf.crs}")
-
-            # Check if contains alpha band
-            contains_alpha_band = -1
-            for idx, interp in enumerate(src.colorinterp, start=1):
-                if interp == rasterio.enums.ColorInterp.alpha:
-                    contains_alpha_band = idx - 1
-
-            if grids[g].geom_type == "MultiPolygon":
-                figure = grids[g]
-            else:
-                figure = MultiPolygon([grids[g]])
-
-            if contains_alpha_band != -1:
-                # Diferentiate the true bands form the mask band.
-                true_bands, masked_band = _extract_bands_from_raster(
-                    src, figure, contains_alpha_band
-                )
-            else:
-                # Returns the las band for fiting.
-                true_bands, masked_band = _extract_bands_from_raster(
-                    src, figure
-                )
-
-            # Get the fitting parameters.
-            cpv, rangle = auto_fit_image(masked_band)
-
-            # Enumerate the bands and name them.
-            if bands_n:
-                bands_name = bands_n
-            else:
-                n_band = np.array(range(0, len(true_bands))) + 1
-                bands_name = ["band" + "_" + str(x) for x in n_band]
-
-            # Fit the bands array with the parameters.
-            fitted_bands = [
-                np.array(Image.fromarray(band).rotate(rangle, expand=True))[
-                    cpv[0] : cpv[1], cpv[2] : cpv[3]
-                ]
-                for band in true_bands
-            ]
-
-            # Save the mean for each band
-            plot_fitted_bands = [
-                np.mean(band.astype(float)) for band in fitted_bands
+        print(f"Raster Coords system: {src.meta['crs']}")
+        print(f"Grid Coords system: {geodf.crs}")
+
+        # Check if contains alpha band
+        contains_alpha_band = _get_alpha_idx(src)
+
+        plot_geoms = grid.geometries_for(src.crs)
+        if engine == "window":
+            order = _block_order(src, plot_geoms)
+            if block_cache is None:
+                block_cache = BlockCache()
+        else:
+            order = list(range(len(plot_geoms)))
+
+        fit_kwargs = dict(
+            alpha_idx=contains_alpha_band,
+            engine=engine,
+            cache=block_cache,
+            fit=fit,
+            hbuffer=hbuffer,
+            wbuffer=wbuffer,
+        )
+        if fit == "grid":
+            fit_kwargs["angle"] = grid_rotation_angle(
+                plot_geoms, src.transform
+            )
+
+        if workers is not None and workers > 1:
+            batches = [
+                [plot_geoms[i] for i in order[j : j + chunk_size]]
+                for j in range(0, len(order), chunk_size)
             ]
-            mp_bands = []
-            # Numerical id for project.
-            id_str = "A" + str(pos + 1)
-            mp_bands.append(id_str)
-            # Original id from the grid can be numerical or text or both.
-            mp_bands.append(g)
-            # gets the date
-            mp_bands.append(os.path.basename(raster_path).split("_")[0])
-            for band in plot_fitted_bands:
-                mp_bands.append(band)
-            bands_mean.append(mp_bands)
-
-            # Save the values in a dictionary.
-            array_dict[pos + 1] = dict(zip(bands_name, fitted_bands))
+            pool = ThreadPoolExecutor(max_workers=workers)
+            fitted_batches = pool.map(
+                partial(_fit_plot_batch, raster_path, **fit_kwargs), batches
+            )
+            # map keeps the order of the batches.
+            fitted = (bands for batch in fitted_batches for bands in batch)
+        else:
+            pool = None
+            fitted = (
+                _fit_plot(src, plot_geoms[i], **fit_kwargs) for i in order
+            )
+
+        bands_mean = [None] * len(order)
+        if out_group is not None:
+            writer = _WRITERS[layout](out_group, get_profile(storage))
+        try:
+            for pos, fitted_bands in zip(order, fitted):
+                # Enumerate the bands and name them.
+                if bands_n:
+                    bands_name = bands_n
+                else:
+                    n_band = np.array(range(0, len(fitted_bands))) + 1
+                    bands_name = ["band" + "_" + str(x) for x in n_band]
+
+                # Save the mean for each band
+                plot_fitted_bands = [
+                    np.mean(band.astype(float)) for band in fitted_bands
+                ]
+                mp_bands = []
+                # Numerical id for project.
+                id_str = "A" + str(pos + 1)
+                mp_bands.append(id_str)
+                # Original id from the grid can be numerical or text or both.
+                mp_bands.append(plot_keys[pos])
+                # gets the date
+                mp_bands.append(os.path.basename(raster_path).split("_")[0])
+                for band in plot_fitted_bands:
+                    mp_bands.append(band)
+                # Back to the original order of the grid.
+                bands_mean[pos] = mp_bands
+
+                # Save the values in a dictionary or stream them to the store.
+                if out_group is not None:
+                    writer.write(id_str, dict(zip(bands_name, fitted_bands)))
+                else:
+                    array_dict[pos + 1] = dict(zip(bands_name, fitted_bands))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    if out_group is not None:
+        writer.close()
+    array_dict = {key: array_dict[key] for key in sorted(array_dict)}
 
     df1 = pd.DataFrame(bands_mean, columns=["id", col_id, "date", *bands_name])
+    # The ids of the grid are already str.
     geodat = geodf
-    geodat[col_id] = geodat[col_id].astype(str)
 
     df = geodat.merge(df1, on=col_id)
     df = df.loc[
@@ -306,7 +1073,52 @@ def extract_raster_data(raster_path, grid_path, col_id: str, bands_n=None):
     return array_dict, bands_name, df
 
 
-def process_stack_tiff(folder_path, grid_path, col_id: str, bands_n=None):
+def _store_flight(
+    raw_data, date_key, to_raw_data, layout="groups", storage=None
+):
+    """Writes the plot arrays of one flight into the raw data group.
+
+    Parameters
+    ----------
+        raw_data:zarr.Group
+            project group that contains the "dates" group.
+        date_key:str
+            date of the flight.
+        to_raw_data:dict
+            dict with the bands arrays of each plot.
+        layout:str
+            "groups" or "ragged", see process_stack_tiff.
+        storage:str or StorageProfile
+            profile used to write the arrays.
+    """
+    date_group = raw_data["dates"].create_group(date_key)
+    writer = _WRITERS[layout](date_group, get_profile(storage))
+
+    for plot_id in to_raw_data.keys():
+        writer.write("A" + str(plot_id), to_raw_data[plot_id])
+    writer.close()
+    return
+
+
+def _extract_flight(raster_path, out_group, **kwargs):
+    """Runs extract_raster_data for one flight of process_stack_tiff."""
+    return extract_raster_data(raster_path, out_group=out_group, **kwargs)
+
+
+def process_stack_tiff(
+    folder_path,
+    grid_path,
+    col_id: str,
+    bands_n=None,
+    workers=None,
+    executor=None,
+    plot_workers=None,
+    engine="mask",
+    fit="image",
+    out_path=None,
+    layout="groups",
+    storage=None,
+):
     """Process all the .tiff files in a folder.
 
     Parameters
@@ -314,11 +1126,38 @@ def process_stack_tiff(folder_path, grid_path, col_id: str, bands_n=None):
         folder_path:str
             folder that contains the .tiff files.
         grid_path:str
-            path of the geojson grid.
+            path of the geojson grid. It is read once for all the flights.
         col_id:str
             unique column name identifier from the grid.
         bands_n:str
             list like with the bands names ordered.
+        workers:int
+            number of processes used to extract the flights in parallel.
+            None or 1 process the flights one at a time.
+        executor:concurrent.futures.Executor
+            executor to use instead of creating a process pool.
+        plot_workers:int
+            number of threads used to extract the plots of each flight.
+        engine:str
+            raster reading engine, "mask" or "window". See
+            extract_raster_data.
+        fit:str
+            plot fitting strategy, "image", "grid" or "geometry". See
+            extract_raster_data.
+        out_path:str
+            directory of the project. When given, the plot arrays are
+            streamed to out_path/raw_data as they are extracted instead of
+            being held in memory, and save(out_path) only writes the
+            metadata.
+        layout:str
+            "groups" stores a group per plot with an array per band.
+            "ragged" stores, for each date, one concatenated array per band
+            and an index with the offset and shape of each plot, which
+            keeps the number of zarr nodes small. Pynomicproject.plot_arrays
+            reads both.
+        storage:str or StorageProfile
+            compressor, dtype and chunking of the plot arrays. A name of
+            Pynomic.core.storage.STORAGE_PROFILES or a StorageProfile.
 
 
     Returns
@@ -326,33 +1165,63 @@ def process_stack_tiff(folder_path, grid_path, col_id: str, bands_n=None):
         PynomicsProject object.
     """
     tif_list = _get_tiff_files(folder_path)
-    raw_data = zarr.group()
+    if out_path is None:
+        raw_data = zarr.group()
+    else:
+        raw_data = zarr.open_group(
+            zarr.DirectoryStore(out_path + "/" + "raw_data"), mode="w"
+        )
     raw_data.create_group("dates")
     dates = []
     ldata = []
     date_key = ""
-    for tiff_pos, tiff_file in enumerate(tif_list):
-        print(f"{tiff_pos + 1}/{len(tif_list)} : {tiff_file}")
+    for tiff_file in tif_list:
         if re.search(r"_", tiff_file):
             date_key = tiff_file.split("_")[0]
-            dates.append(date_key)
+        dates.append(date_key)
 
-        to_raw_data, bands_n, ldata_bands = extract_raster_data(
-            folder_path + "/" + tiff_file, grid_path, col_id, bands_n
-        )
+    if out_path is None:
+        out_groups = [None] * len(dates)
+    else:
+        out_groups = [raw_data["dates"].create_group(d) for d in dates]
+
+    tif_paths = [folder_path + "/" + tiff_file for tiff_file in tif_list]
+    n_tifs = len(tif_paths)
+    pool = None
+    if executor is None and workers is not None and workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        executor = pool
+
+    extract = partial(
+        _extract_flight,
+        grid_path=load_grid(grid_path, col_id),
+        col_id=col_id,
+        bands_n=bands_n,
+        workers=plot_workers,
+        engine=engine,
+        fit=fit,
+        layout=layout,
+        storage=storage,
+    )
+    if executor is not None:
+        results = executor.map(extract, tif_paths, out_groups)
+    else:
+        results = map(extract, tif_paths, out_groups)
 
-        raw_data["dates"].create_group(date_key)
+    # Results are consumed in the (date) order of the tiff list.
+    try:
+        for tiff_pos, (tiff_file, flight) in enumerate(zip(tif_list, results)):
+            print(f"{tiff_pos + 1}/{n_tifs} : {tiff_file}")
+            to_raw_data, bands_n, ldata_bands = flight
 
-        for plot_id in to_raw_data.keys():
-            c = "A" + str(plot_id)
-            raw_data["dates"][date_key].create_group(c)
-            for band in to_raw_data[plot_id].keys():
-                raw_data["dates"][date_key][c].create_group(band)
-                raw_data["dates"][date_key][c][band] = to_raw_data[plot_id][
-                    band
-                ]
-        # ldata_bands = ldata_bands.reset_index().drop(columns= 'index', axis = 1)
-        ldata.append(ldata_bands)
+            if out_path is None:
+                _store_flight(
+                    raw_data, dates[tiff_pos], to_raw_data, layout, storage
+                )
+            ldata.append(ldata_bands)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     df_data = pd.concat(ldata, axis=0).reset_index().drop(columns="index")
 
@@ -366,29 +1235,153 @@ def process_stack_tiff(folder_path, grid_path, col_id: str, bands_n=None):
     )
 
 
-def read_zarr(path):
+_FILTER_OPS = {
+    "==": lambda col, val: col == val,
+    "=": lambda col, val: col == val,
+    "!=": lambda col, val: col != val,
+    "<": lambda col, val: col < val,
+    "<=": lambda col, val: col <= val,
+    ">": lambda col, val: col > val,
+    ">=": lambda col, val: col >= val,
+    "in": lambda col, val: col.isin(val),
+    "not in": lambda col, val: ~col.isin(val),
+}
+
+
+def _apply_filters(df, filters):
+    """Keeps the rows of a DataFrame that pass all the filters.
+
+    Parameters
+    ----------
+        df:DataFrame
+            data to filter.
+        filters:list
+            list of (column, op, value) tuples, as the pyarrow filters.
+
+    Returns
+    -------
+        DataFrame
+    """
+    keep = np.ones(len(df), dtype=bool)
+    for col, op, val in filters:
+        keep &= np.asarray(_FILTER_OPS[op](df[col], val))
+    return df.loc[keep].reset_index(drop=True)
+
+
+def _read_ldata(path, ldata_format, columns=None, filters=None):
+    """Reads the ldata saved with a project.
+
+    Parameters
+    ----------
+        path:str
+            a path to the project directory.
+        ldata_format:str
+            "shapefile" or "parquet".
+        columns:list
+            columns to read, the geometry is always read.
+        filters:list
+            list of (column, op, value) tuples to select rows.
+
+    Returns
+    -------
+        GeoDataFrame
+    """
+    if columns is not None and "geometry" not in columns:
+        columns = [*columns, "geometry"]
+
+    if ldata_format == "parquet":
+        # Column pruning and row filters are pushed down to pyarrow.
+        return gdp.read_parquet(
+            path + "/" + "ldata.parquet", columns=columns, filters=filters
+        )
+
+    if columns is not None:
+        columns = [col for col in columns if col != "geometry"]
+    data = gdp.read_file(path + "/" + "ldata.shp", columns=columns)
+    if filters:
+        data = _apply_filters(data, filters)
+    return data
+
+
+def _open_raw_data(raw_path, consolidated=True):
+    """Opens the raw data group of a saved project."""
+    if consolidated and os.path.exists(raw_path + "/" + ".zmetadata"):
+        return zarr.open_consolidated(raw_path, mode="r+")
+    return zarr.open_group(raw_path, mode="a")
+
+
+def read_zarr(
+    path,
+    consolidated=True,
+    columns=None,
+    filters=None,
+    lazy=False,
+    dates=None,
+    ids=None,
+):
     """Reads a zarr project previously saved from pynomics.
 
     Parameters
     ----------
         path:str
             a path to the directory
+        consolidated:bool
+            open the raw data with the consolidated metadata written by
+            save, so opening it does not read the metadata of every group.
+            Projects without it are opened normally.
+        columns:list
+            columns of ldata to read. None reads all of them.
+        filters:list
+            list of (column, op, value) tuples to read only some rows of
+            ldata, for example [("date", "in", ["20180815"])]. With the
+            parquet format they are applied while reading.
+        lazy:bool
+            defer reading ldata and opening the raw data until they are
+            first used.
+        dates:list
+            dates of the project to read. None reads all of them.
+        ids:list
+            ids of the plots to read. None reads all of them.
+
     Returns
     -------
         Pynomicproject object
     """
-    store = zarr.open_group(path + "/" + "raw_data", mode="a")
-
-    data1 = gdp.read_file(path + "/" + "ldata.shp")
-
     with open(path + "/" + "obj_properties.json", "r") as file:
         prop = dict(json.load(file))
 
+    proj_dates = prop["dates"]
+    ldata_filters = list(filters) if filters else []
+    if dates is not None:
+        missing = [d for d in dates if d not in proj_dates]
+        if missing:
+            raise ValueError(f"Dates {missing} are not in the project")
+        proj_dates = [d for d in proj_dates if d in dates]
+        ldata_filters.append(("date", "in", list(dates)))
+    if ids is not None:
+        ids = list(ids)
+        ldata_filters.append(("id", "in", ids))
+
+    load_ldata = partial(
+        _read_ldata,
+        path,
+        prop.get("ldata_format", "shapefile"),
+        columns=columns,
+        filters=ldata_filters or None,
+    )
+    load_raw = partial(
+        _open_raw_data, path + "/" + "raw_data", consolidated=consolidated
+    )
+
     return core.Pynomicproject(
-        raw_data=store,
-        ldata=data1.copy(),
-        n_dates=len(prop["dates"]),
-        dates=prop["dates"],
+        raw_data=None if lazy else load_raw(),
+        ldata=None if lazy else load_ldata(),
+        n_dates=len(proj_dates),
+        dates=proj_dates,
         n_bands=len(prop["bands"]),
         bands_name=prop["bands"],
+        ldata_loader=load_ldata,
+        raw_loader=load_raw,
+        plots=ids,
+        partial=bool(columns or ldata_filters),
     )
@@ -9,9 +9,10 @@
 # =============================================================================
 import os
 import shutil
+import time
 
 import Pynomic
-from Pynomic.core import core
+from Pynomic.core import core, storage
 from Pynomic.io import get_plot_bands
 
 
@@ -21,6 +22,8 @@ import pandas as pd
 
 import pytest
 
+from skimage.feature import graycomatrix, graycoprops
+
 import zarr
 
 # =============================================================================
@@ -123,6 +126,204 @@ def test_generate_unique_feature():
     return
 
 
+def test_plot_arrays():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt_ragged = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        layout="ragged",
+    )
+
+    assert pyt.plot_ids("20180815") == ["A1", "A2", "A3", "A4"]
+    arrays = pyt.plot_arrays("20180815", "A1")
+    assert list(arrays.keys()) == ["red", "green", "blue"]
+    np.testing.assert_array_equal(
+        arrays["red"], pyt.raw_data["dates"]["20180815"]["A1"]["red"][:]
+    )
+
+    def VDVI_index(df):
+        red = np.mean(df["red"])
+        green = np.mean(df["green"])
+        blue = np.mean(df["blue"])
+
+        return [(2 * green - red - blue) / (2 * green + red + blue)]
+
+    data = pyt.generate_unique_feature(VDVI_index, ["VDVI"])
+    data_ragged = pyt_ragged.generate_unique_feature(VDVI_index, ["VDVI"])
+    pd.testing.assert_frame_equal(
+        data_ragged.sort_values(["date", "id"]).reset_index(drop=True),
+        data.sort_values(["date", "id"]).reset_index(drop=True),
+    )
+
+    return
+
+
+def test_iter_plot_arrays():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        layout="ragged",
+    )
+
+    items = list(pyt.iter_plot_arrays())
+    assert len(items) == 7 * 4
+    assert [(d, p) for d, p, _ in items[:4]] == [
+        (pyt.dates[0], p) for p in ["A1", "A2", "A3", "A4"]
+    ]
+    for date, plot, arrays in items:
+        expected = pyt.plot_arrays(date, plot)
+        for band in pyt.bands_name:
+            np.testing.assert_array_equal(arrays[band], expected[band])
+
+    items = list(
+        pyt.iter_plot_arrays(
+            dates=["20180822"], plots=["A3"], bands=["green"], prefetch=0
+        )
+    )
+    assert len(items) == 1
+    date, plot, arrays = items[0]
+    assert (date, plot) == ("20180822", "A3")
+    assert list(arrays.keys()) == ["green"]
+
+    items = list(pyt.iter_plot_arrays(dates=["20180822"], plots=["A3", "A1"]))
+    assert [p for _, p, _ in items] == ["A3", "A1"]
+    with pytest.raises(KeyError):
+        list(pyt.iter_plot_arrays(plots=["Z9"]))
+
+    return
+
+
+def test_iter_plot_arrays_lookup():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    store = _CountingStore()
+    zarr.copy_store(pyt.raw_data.store, store)
+    pyt.raw_data = zarr.open_group(store, mode="r")
+    store.lookups.clear()
+
+    items = list(pyt.iter_plot_arrays(plots=["A2"]))
+    assert [p for _, p, _ in items] == ["A2"] * len(pyt.dates)
+    # The other plots are not listed nor read.
+    others = [k for k in store.reads if "/A1/" in k or "/A3/" in k]
+    others += [k for k in store.lookups if "/A1/" in k or "/A3/" in k]
+    assert not others
+
+    with pytest.raises(KeyError):
+        list(pyt.iter_plot_arrays(plots=["Z9"]))
+    with pytest.raises(KeyError):
+        pyt.plot.image_timeline("red", "Z9", lambda arrays: arrays["red"])
+
+    return
+
+
+class _CountingStore(dict):
+    """Store that counts the reads and lookups of each key."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.reads = {}
+        self.lookups = set()
+
+    def __getitem__(self, key):
+        self.reads[key] = self.reads.get(key, 0) + 1
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.lookups.add(key)
+        return super().__contains__(key)
+
+
+def test_iter_plot_arrays_ragged_reads():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        layout="ragged",
+    )
+    expected = {
+        (date, plot): arrays for date, plot, arrays in pyt.iter_plot_arrays()
+    }
+
+    store = _CountingStore()
+    zarr.copy_store(pyt.raw_data.store, store)
+    pyt.raw_data = zarr.open_group(store, mode="r")
+    for date, plot, arrays in pyt.iter_plot_arrays(bands=["red"]):
+        np.testing.assert_array_equal(
+            arrays["red"], expected[(date, plot)]["red"]
+        )
+
+    # Each chunk is decoded once, not once per plot.
+    for date in pyt.dates:
+        red = pyt.raw_data["dates"][date]["red"]
+        assert red.nchunks < len(pyt.plot_ids(date))
+        for i in range(red.nchunks):
+            assert store.reads[f"dates/{date}/red/{i}"] == 1
+
+    return
+
+
+def test_chunk_reader():
+    store = _CountingStore()
+    values = np.arange(5 * 2**20, dtype=np.float64)
+    arr = zarr.array(values, chunks=len(values), store=store)
+    read = core._chunk_reader(arr)
+
+    # A single decode, and the runs do not keep the chunk alive.
+    start = time.perf_counter()
+    for i in range(200):
+        run = read(i * 1000, (i + 1) * 1000)
+        assert run.base is None
+        np.testing.assert_array_equal(run, values[i * 1000 + np.arange(1000)])
+    assert time.perf_counter() - start < 5
+    assert store.reads["0"] == 1
+
+    arr = zarr.array(values[:10000], chunks=4096)
+    read = core._chunk_reader(arr, max_chunks=1)
+    np.testing.assert_array_equal(read(4000, 9000), values[4000:9000])
+    assert read(50, 50).shape == (0,)
+
+    return
+
+
+def _mean_red(arrays):
+    return [float(np.mean(arrays["red"]))]
+
+
+def test_generate_unique_feature_parallel():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+
+    data = pyt.generate_unique_feature(_mean_red, ["mean_red"])
+    data_threads = pyt.generate_unique_feature(
+        _mean_red, ["mean_red"], n_jobs=2, chunk_size=3
+    )
+    data_processes = pyt.generate_unique_feature(
+        _mean_red, ["mean_red"], n_jobs=2, backend="processes", chunk_size=5
+    )
+    pd.testing.assert_frame_equal(data_threads, data)
+    pd.testing.assert_frame_equal(data_processes, data)
+
+    return
+
+
 def test_senescence_prediction():
     pyt = get_plot_bands.process_stack_tiff(
         "add_on/flights",
@@ -284,6 +485,88 @@ def test_Multispectral_VI():
     return
 
 
+def test_GLCM_TI_levels():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    n_cols = pyt.ldata.shape[1]
+
+    data = pyt.Calcualte_TI_GLCM([1, 2], [0, 90]).copy()
+    assert data.shape[1] == n_cols + 2 * 2 * 3 * 5
+    assert list(data.columns[n_cols:][:6]) == [
+        "red_1_0_cont",
+        "red_1_0_disst",
+        "red_1_0_homog",
+        "red_1_0_energy",
+        "red_1_0_corr",
+        "green_1_0_cont",
+    ]
+    assert data.columns[-1] == "blue_2_90_corr"
+
+    arrays = pyt.plot_arrays(pyt.dates[0], "A1")
+    gray = arrays["red"]
+    if gray.dtype != np.uint8:
+        gray = gray.astype(float)
+        gray *= 255 / np.round(gray, 6).max()
+        gray = np.uint8(np.round(gray, 0).astype(int))
+    glcm = graycomatrix(
+        gray, [2], [90], levels=256, symmetric=True, normed=True
+    )
+    row = data.loc[(data.id == "A1") & (data.date == pyt.dates[0])]
+    assert row["red_2_90_cont"].iloc[0] == round(
+        graycoprops(glcm, "contrast")[0][0], 4
+    )
+
+    pyt.ldata = pyt.ldata.iloc[:, :n_cols]
+    data_parallel = pyt.Calcualte_TI_GLCM([1, 2], [0, 90], n_jobs=2)
+    pd.testing.assert_frame_equal(data_parallel, data)
+
+    pyt.ldata = pyt.ldata.iloc[:, :n_cols]
+    data32 = pyt.Calcualte_TI_GLCM([1, 2], [0, 90], levels=32)
+    assert list(data32.columns) == list(data.columns)
+    assert (data32["red_1_0_cont"] < data["red_1_0_cont"]).all()
+
+    return
+
+
+def test_GLCM_TI_rounding():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    angles = [0, np.pi / 4]
+    data = pyt.Calcualte_TI_GLCM([1, 2], angles)
+
+    # A matrix per distance and angle gives the same values up to the
+    # rounding of the last digit.
+    props = {"cont": "contrast", "disst": "dissimilarity"}
+    for date, plot, arrays in pyt.iter_plot_arrays(bands=["red"]):
+        gray = arrays["red"]
+        if gray.dtype != np.uint8:
+            gray = gray.astype(float)
+            gray *= 255 / np.round(gray, 6).max()
+            gray = np.uint8(np.round(gray, 0).astype(int))
+        row = data.loc[(data.id == plot) & (data.date == date)]
+        for angle in angles:
+            glcm = graycomatrix(
+                gray, [1], [angle], levels=256, symmetric=True, normed=True
+            )
+            for name, prop in props.items():
+                np.testing.assert_allclose(
+                    row[f"red_1_{angle}_{name}"].iloc[0],
+                    round(graycoprops(glcm, prop)[0][0], 4),
+                    rtol=0,
+                    atol=1e-4 + 1e-9,
+                )
+
+    return
+
+
 def test_GLMC_TI():
     pyt = get_plot_bands.process_stack_tiff(
         "add_on/MFlights",
@@ -361,6 +644,145 @@ def test_calc_green_px():
         == 0.77
     )
 
+    dat_batched = pyt.Calcualte_green_pixels(
+        Red="red",
+        Blue="blue",
+        Green="green",
+        image_shape=(0, 180, 0, 45),
+        n_jobs=2,
+        batch_size=7,
+    )
+    pd.testing.assert_frame_equal(dat_batched, dat)
+
+    return
+
+
+def test_green_pixels_sweep():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+
+    hists = pyt.hue_histograms("red", "blue", "green", (1,))
+    assert hists.shape == (7 * 4, 181)
+    assert (hists[list(range(180))].sum(axis=1) <= hists["n_px"]).all()
+
+    ranges = [(30, 75), (20, 50)]
+    sweep = pyt.green_pixels_sweep(
+        "red", "blue", "green", (1,), ranges, batch_size=5
+    )
+    assert len(sweep) == 2 * 7 * 4
+    for min_val, max_val in ranges:
+        dat = pyt.Calcualte_green_pixels(
+            "red", "blue", "green", (1,), min_val=min_val, max_val=max_val
+        )
+        sel = sweep.loc[
+            (sweep.min_val == min_val) & (sweep.max_val == max_val)
+        ]
+        pd.testing.assert_frame_equal(
+            sel.drop(columns=["min_val", "max_val"]).reset_index(drop=True),
+            dat,
+            check_dtype=False,
+        )
+
+    return
+
+
+def test_hue_histograms_cache(monkeypatch):
+    out_path = "add_on/zarr_data/hue_cache_group"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt.save(out_path)
+    pyt = get_plot_bands.read_zarr(out_path)
+
+    dat = pyt.Calcualte_green_pixels("red", "blue", "green", (1,))
+    dat_cache = pyt.Calcualte_green_pixels(
+        "red", "blue", "green", (1,), cache=True
+    )
+    pd.testing.assert_frame_equal(dat_cache, dat)
+
+    # A reopened project answers from the cache without reading arrays.
+    pyt = get_plot_bands.read_zarr(out_path)
+    read_dates = []
+    date_reader = core.Pynomicproject._date_reader
+
+    def _tracked_reader(self, date, bands=None):
+        read_dates.append(date)
+        return date_reader(self, date, bands)
+
+    monkeypatch.setattr(core.Pynomicproject, "_date_reader", _tracked_reader)
+    dat_cache = pyt.Calcualte_green_pixels(
+        "red", "blue", "green", (1,), cache=True
+    )
+    pd.testing.assert_frame_equal(dat_cache, dat)
+    assert read_dates == []
+
+    # Writing a date again invalidates only its histograms.
+    root = zarr.open_group(out_path + "/raw_data", mode="a")
+    storage.bump_revision(root["dates"]["20180822"])
+    pyt.green_pixels_sweep("red", "blue", "green", (1,), [(30, 75)])
+    assert read_dates == ["20180822"]
+
+    shutil.rmtree(out_path)
+
+    return
+
+
+def test_hue_histograms_cache_ids(monkeypatch):
+    out_path = "add_on/zarr_data/hue_cache_ids"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt.save(out_path)
+    hists = pyt.hue_histograms("red", "blue", "green", (1,), cache=False)
+
+    read_plots = []
+    date_reader = core.Pynomicproject._date_reader
+
+    def _tracked_reader(self, date, bands=None):
+        read = date_reader(self, date, bands)
+
+        def _read(plot):
+            read_plots.append(plot)
+            return read(plot)
+
+        return _read
+
+    monkeypatch.setattr(core.Pynomicproject, "_date_reader", _tracked_reader)
+
+    # The histograms of each ids selection are merged into the cache.
+    for ids in [["A1"], ["A2", "A3"]]:
+        pyt = get_plot_bands.read_zarr(out_path, ids=ids)
+        pyt.hue_histograms("red", "blue", "green", (1,))
+        assert set(read_plots) == set(ids)
+        read_plots.clear()
+
+    pyt = get_plot_bands.read_zarr(out_path)
+    hists_cache = pyt.hue_histograms("red", "blue", "green", (1,))
+    assert set(read_plots) == {"A4"}
+    pd.testing.assert_frame_equal(hists_cache, hists)
+
+    read_plots.clear()
+    pyt.hue_histograms("red", "blue", "green", (1,))
+    assert read_plots == []
+
+    shutil.rmtree(out_path)
+
     return
 
 
@@ -0,0 +1,227 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: MIT
+# Copyright (c) 2024, Fiore J.Manuel.
+# All rights reserved.
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+from Pynomic.core import senescence
+from Pynomic.io import get_plot_bands
+
+
+import numpy as np
+
+import pandas as pd
+
+import pytest
+
+from scipy.interpolate import interp1d
+
+from sklearn.linear_model import LinearRegression
+
+from statsmodels.nonparametric.smoothers_lowess import lowess
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def _vdvi_project():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+
+    def VDVI_index(df):
+        red = np.mean(df["red"])
+        green = np.mean(df["green"])
+        blue = np.mean(df["blue"])
+
+        return [(2 * green - red - blue) / (2 * green + red + blue)]
+
+    pyt.generate_unique_feature(VDVI_index, ["VDVI"], True)
+    return pyt
+
+
+def test_curve_matrix():
+    df = pd.DataFrame(
+        {
+            "id": ["b", "a", "b", "a", "b"],
+            "num_day": [7, 0, 0, 7, 14],
+            "val": [0.5, 0.9, 0.8, np.nan, 0.2],
+        }
+    )
+    matrix = senescence.CurveMatrix.from_frame(df, "val")
+
+    assert list(matrix.ids) == ["b", "a"]
+    np.testing.assert_array_equal(matrix.days[0], [0, 7, 14])
+    np.testing.assert_array_equal(matrix.values[0], [0.8, 0.5, 0.2])
+    np.testing.assert_array_equal(matrix.days[1], [0, np.nan, np.nan])
+    # The first half follows the order of the rows, not the days.
+    np.testing.assert_array_equal(matrix.half_max, [0.5, 0.9])
+    np.testing.assert_array_equal(matrix.min, [0.2, 0.9])
+
+    x, y = matrix.plot_curve(1)
+    np.testing.assert_array_equal(x, [0])
+    np.testing.assert_array_equal(y, [0.9])
+
+    return
+
+
+def test_threshold_crossing():
+    days = np.array([[0, 7, 14, 21], [0, 7, 14, 21], [0, 7, 14, 21]])
+    values = np.array(
+        [[0.9, 0.7, 0.3, 0.1], [0.9, 0.8, 0.7, 0.6], [0.9, 0.5, 0.5, 0.1]]
+    )
+    pred = senescence.threshold_crossing(days, values, 0.5)
+
+    lm = LinearRegression().fit(
+        np.array([[0.7], [0.3]]), np.array([[7], [14]])
+    )
+    assert pred[0] == round(lm.predict(np.array([[0.5]]))[0][0])
+    assert pred[1] == -999
+    assert pred[2] == 7
+
+    return
+
+
+def test_threshold_estimation_vectorized():
+    pyt = _vdvi_project()
+
+    for threshold in [0.001, 0.05, 0.1, 0.2]:
+        for from_day in [0, 10]:
+            df_loop = pyt.get_threshold_estimation(
+                "VDVI", threshold, from_day=from_day
+            )
+            df_vec = pyt.get_threshold_estimation(
+                "VDVI", threshold, from_day=from_day, engine="vectorized"
+            )
+            pd.testing.assert_frame_equal(df_vec, df_loop)
+
+    return
+
+
+def test_spline_predictions_batched():
+    pyt = _vdvi_project()
+
+    for threshold in [0.05, 0.1]:
+        df_loop = pyt.get_senescens_Splines_predictions("VDVI", threshold)
+        df_batch = pyt.get_senescens_Splines_predictions(
+            "VDVI", threshold, engine="batched"
+        )
+        pd.testing.assert_frame_equal(df_batch, df_loop)
+
+    df_batch = pyt.get_senescens_Splines_predictions(
+        "VDVI", 0.001, engine="batched"
+    )
+    df_parallel = pyt.get_senescens_Splines_predictions(
+        "VDVI", 0.001, engine="batched", n_jobs=2
+    )
+    pd.testing.assert_frame_equal(df_parallel, df_batch)
+
+    return
+
+
+def test_loess_smooth():
+    rng = np.random.default_rng(0)
+    x = np.array([0.0, 7, 14, 21, 30, 33, 41])
+    y = rng.normal(size=(20, len(x))).cumsum(axis=1)
+    y[0] = 1.0
+
+    for frac in [0.3, 0.5, 1.0]:
+        fit = senescence.loess_smooth(x, y, frac)
+        expected = np.array([lowess(row, x, frac=frac)[:, 1] for row in y])
+        np.testing.assert_allclose(fit, expected, atol=1e-12)
+
+    days = senescence.inverse_interp(x, expected, 0.3)
+    for row, day in zip(expected[1:], days[1:]):
+        f = interp1d(row, x, kind="linear", fill_value="extrapolate")
+        assert day == f(0.3)
+
+    return
+
+
+def test_loess_predictions_matrix():
+    pyt = _vdvi_project()
+
+    for threshold in [0.001, 0.05, 0.1]:
+        df_loop = pyt.get_senescens_Loess_predictions("VDVI", threshold)
+        df_matrix = pyt.get_senescens_Loess_predictions(
+            "VDVI", threshold, engine="matrix"
+        )
+        pd.testing.assert_frame_equal(df_matrix, df_loop)
+
+    return
+
+
+def test_curve_data_predict():
+    pyt = _vdvi_project()
+    curves = pyt.senescence_curves()
+
+    pred = curves.predict("VDVI", 0.2)
+    upper = pred.loc[pred.in_range == "upper"]
+    assert set(upper.status) == {"upper than range", "root not found"}
+    # A failed root search keeps the value of the loop engine.
+    assert (upper.loc[upper.status == "root not found", "dpred"] == 0).all()
+    assert (pred.loc[pred.in_range == "IN", "status"] == "ok").all()
+
+    # The matrix is built once and shared by the thresholds and models.
+    matrix = curves.matrix("VDVI")
+    for model in ["threshold", "splines", "loess"]:
+        for threshold in [0.05, 0.1]:
+            single = curves.predict("VDVI", threshold, model)
+            chunked = curves.predict(
+                "VDVI", threshold, model, n_jobs=2, chunk_size=50
+            )
+            pd.testing.assert_frame_equal(chunked, single)
+    assert curves.matrix("VDVI") is matrix
+
+    df_curves = pyt.get_threshold_estimation(
+        "VDVI", 0.1, engine="vectorized", curves=curves
+    )
+    df = pyt.get_threshold_estimation("VDVI", 0.1, engine="vectorized")
+    pd.testing.assert_frame_equal(df_curves, df)
+
+    with pytest.raises(ValueError):
+        curves.predict("VDVI", 0.1, "linear")
+
+    return
+
+
+def test_threshold_sweep():
+    pyt = _vdvi_project()
+    thresholds = [0.001, 0.05, 0.1, 0.2]
+
+    sweep = pyt.get_threshold_sweep(["VDVI", "VDVI"], thresholds)
+    n_plots = pyt.ldata.id.nunique()
+    assert len(sweep) == 2 * len(thresholds) * n_plots
+    assert list(sweep.columns) == [
+        "band",
+        "threshold",
+        "id",
+        "dpred",
+        "in_range",
+        "status",
+    ]
+
+    for threshold in thresholds:
+        df_loop = pyt.get_threshold_estimation("VDVI", threshold)
+        plots = df_loop.drop_duplicates("id").set_index("id")
+        rows = sweep.loc[sweep.threshold == threshold].iloc[:n_plots]
+        rows = rows.set_index("id")
+        pd.testing.assert_series_equal(
+            rows["dpred"], plots.loc[rows.index, "dpred"]
+        )
+        pd.testing.assert_series_equal(
+            rows["in_range"], plots.loc[rows.index, "in_range"]
+        )
+
+    sweep = pyt.get_threshold_sweep("VDVI", 0.2, extrapolate=False)
+    assert sweep.loc[sweep.in_range != "IN", "dpred"].isna().all()
+    assert sweep.loc[sweep.in_range == "IN", "dpred"].notna().all()
+
+    return
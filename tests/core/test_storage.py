@@ -0,0 +1,173 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: MIT
+# Copyright (c) 2024, Fiore J.Manuel.
+# All rights reserved.
+
+# =============================================================================
+# IMPORTS
+# =============================================================================
+import os
+import shutil
+
+import Pynomic
+from Pynomic.core import storage
+from Pynomic.io import get_plot_bands
+
+
+import numpy as np
+
+import pandas as pd
+
+import pytest
+
+import zarr
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+
+
+def test_get_profile():
+    assert storage.get_profile() == storage.STORAGE_PROFILES["default"]
+    assert storage.get_profile("compact").cname == "zstd"
+
+    profile = storage.StorageProfile(cname="zlib", clevel=1)
+    assert storage.get_profile(profile) is profile
+
+    with pytest.raises(ValueError):
+        storage.get_profile("smallest")
+
+    return
+
+
+def test_profile_cast():
+    arr = np.array([[1.4, 2.6], [-3.0, 70000.0]])
+
+    assert storage.StorageProfile().cast(arr).dtype == np.float64
+    assert (
+        storage.StorageProfile(float_dtype="float32").cast(arr).dtype
+        == np.float32
+    )
+    np.testing.assert_array_equal(
+        storage.StorageProfile(float_dtype="uint16", scale=10).cast(arr),
+        np.array([[1.4, 2.6], [0, 6553.5]]),
+    )
+    with pytest.raises(ValueError):
+        storage.StorageProfile(float_dtype="uint16")
+    ints = np.array([1, 2], dtype=np.uint8)
+    assert (
+        storage.StorageProfile(float_dtype="float32").cast(ints).dtype
+        == np.uint8
+    )
+
+    return
+
+
+def test_profile_scale():
+    group = zarr.group()
+    profile = storage.StorageProfile(float_dtype="uint16", scale=10000)
+    arr = np.array([0.12345, 0.5, 1.0, 7.0])
+
+    stored = profile.write(group, "red", arr)
+    assert stored.dtype == np.float64
+    np.testing.assert_array_equal(
+        stored[:], np.array([0.1234, 0.5, 1.0, 65535 / 10000])
+    )
+    assert stored.filters[0].astype == np.dtype("uint16")
+
+    return
+
+
+def test_ragged_tuple_chunks():
+    out_path = "add_on/zarr_data/profile_ragged"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+    profile = storage.StorageProfile(chunks=(64, 64))
+    assert profile.chunks_for(2) == (64, 64)
+    assert profile.chunks_for(1) == (4096,)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        layout="ragged",
+        storage=profile,
+    )
+    arr = pyt.raw_data["dates"]["20180815"]["red"]
+    assert arr.chunks == (4096,)
+
+    pyt.save(out_path, storage=storage.StorageProfile(chunks=(32, 32)))
+    pyt1 = Pynomic.read_zarr(out_path)
+    arr1 = pyt1.raw_data["dates"]["20180815"]["red"]
+    assert arr1.chunks == (1024,)
+    np.testing.assert_array_equal(arr1[:], arr[:])
+    for date, plot, arrays in pyt1.iter_plot_arrays(plots=["A1"]):
+        np.testing.assert_array_equal(
+            arrays["red"], pyt.plot_arrays(date, plot)["red"]
+        )
+    shutil.rmtree(out_path)
+
+    # A single chunk profile does not put a whole date in one chunk.
+    assert storage.get_profile("fast").chunks_for(1) == (storage.RAGGED_CHUNK,)
+    pyt.save(out_path, storage="compact")
+    pyt1 = Pynomic.read_zarr(out_path)
+    arr1 = pyt1.raw_data["dates"]["20180815"]["red"]
+    assert arr1.chunks == (storage.RAGGED_CHUNK,)
+    assert pyt1.raw_data["dates"]["20180815"]["index"].ndim == 2
+    np.testing.assert_array_equal(arr1[:], arr[:])
+
+    shutil.rmtree(out_path)
+
+    return
+
+
+def test_save_with_profile():
+    out_path = "add_on/zarr_data/profile_group"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        storage="fast",
+    )
+    arr = pyt.raw_data["dates"]["20180815"]["A1"]["red"]
+    assert arr.compressor.clevel == 1
+    assert arr.chunks == arr.shape
+
+    pyt.save(out_path, storage="compact")
+    pyt1 = Pynomic.read_zarr(out_path)
+    arr1 = pyt1.raw_data["dates"]["20180815"]["A1"]["red"]
+    assert arr1.compressor.cname == "zstd"
+    np.testing.assert_array_equal(arr1[:], arr[:])
+
+    with pytest.raises(ValueError):
+        pyt1.save(out_path, storage="fast")
+
+    shutil.rmtree(out_path)
+
+    return
+
+
+def test_benchmark_storage_profiles():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+
+    bench = storage.benchmark_storage_profiles(pyt)
+
+    assert isinstance(bench, pd.DataFrame)
+    assert list(bench.profile) == list(storage.STORAGE_PROFILES)
+    assert (bench.bytes_on_disk > 0).all()
+    assert (bench.bytes_raw == bench.bytes_raw[0]).all()
+    assert (bench.read_mb_s > 0).all()
+    assert isinstance(pyt.raw_data, zarr.Group)
+
+    return
@@ -7,12 +7,30 @@
 # =============================================================================
 # IMPORTS
 # =============================================================================
+import os
+import shutil
+
+from PIL import Image
 
 from Pynomic.core import core
 from Pynomic.io import get_plot_bands
 
+from affine import Affine
+
 import geopandas as gpd
 
+import numpy as np
+
+import pandas as pd
+
+import pytest
+
+import rasterio
+
+from shapely.geometry import box
+
+import zarr
+
 # =============================================================================
 # FUNCTIONS
 # =============================================================================
@@ -64,6 +82,482 @@ def test_proces_stack_tiff_no_name_bands():
     return
 
 
+def test_proces_stack_tiff_workers():
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt_par = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        workers=2,
+    )
+
+    assert pyt_par.dates == pyt.dates
+    assert pyt_par.dates == sorted(pyt.dates)
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(pyt_par.ldata), pd.DataFrame(pyt.ldata)
+    )
+    for d in pyt.dates:
+        for p in pyt.raw_data["dates"][d].group_keys():
+            np.testing.assert_array_equal(
+                pyt_par.raw_data["dates"][d][p]["red"][:],
+                pyt.raw_data["dates"][d][p]["red"][:],
+            )
+
+    return
+
+
+def test_extract_raster_data_workers():
+    arrays, bands, df = get_plot_bands.extract_raster_data(
+        "add_on/flights/20180815_Lamberton_clipped.tif",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    arrays_par, bands_par, df_par = get_plot_bands.extract_raster_data(
+        "add_on/flights/20180815_Lamberton_clipped.tif",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        workers=3,
+        chunk_size=7,
+    )
+
+    assert bands_par == bands
+    assert list(arrays_par.keys()) == list(arrays.keys())
+    pd.testing.assert_frame_equal(pd.DataFrame(df_par), pd.DataFrame(df))
+    for p in arrays.keys():
+        for b in bands:
+            np.testing.assert_array_equal(arrays_par[p][b], arrays[p][b])
+
+    return
+
+
+def test_extract_raster_data_window_engine():
+    arrays, bands, df = get_plot_bands.extract_raster_data(
+        "add_on/flights/20180829_Lamberton_clipped.tif",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+    )
+    arrays_win, bands_win, df_win = get_plot_bands.extract_raster_data(
+        "add_on/flights/20180829_Lamberton_clipped.tif",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+        engine="window",
+    )
+
+    assert bands_win == bands
+    assert list(arrays_win.keys()) == list(arrays.keys())
+    pd.testing.assert_frame_equal(pd.DataFrame(df_win), pd.DataFrame(df))
+    for p in arrays.keys():
+        for b in bands:
+            np.testing.assert_array_equal(arrays_win[p][b], arrays[p][b])
+
+    return
+
+
+def test_block_cache():
+    cache = get_plot_bands.BlockCache()
+    with rasterio.open("add_on/flights/20180829_Lamberton_clipped.tif") as src:
+        window = rasterio.windows.Window(100, 50, 30, 20)
+        data, valid = cache.read_window(src, window)
+
+        np.testing.assert_array_equal(data, src.read(window=window))
+        np.testing.assert_array_equal(valid, src.read_masks(window=window))
+        assert cache.misses == 20
+        assert cache.hits == 0
+
+        cache.read_window(src, window)
+        assert cache.hits == 20
+
+        block_bytes = cache.nbytes // len(cache)
+        small = get_plot_bands.BlockCache(max_bytes=5 * block_bytes)
+        small.read_window(src, window)
+        assert len(small) == 5
+        assert small.nbytes <= small.max_bytes
+
+    return
+
+
+def test_load_grid():
+    grid = get_plot_bands.load_grid(
+        "add_on/Grids/Labmert_test_grid.geojson", "fid"
+    )
+
+    assert isinstance(grid, get_plot_bands.PlotGrid)
+    assert grid is get_plot_bands.load_grid(
+        "add_on/Grids/Labmert_test_grid.geojson", "fid"
+    )
+    assert len(grid.ids) == 40
+    assert grid.ids[0] == "1"
+    assert grid.bounds.shape == (40, 4)
+    assert grid.geometries_for(grid.crs) is grid.geometries
+
+    projected = grid.geometries_for("EPSG:4326")
+    assert projected is grid.geometries_for("EPSG:4326")
+    assert projected[0].bounds[0] < 0
+
+    return
+
+
+def test_rotate_bands():
+    band = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    rotated = get_plot_bands.rotate_bands([band, band * 2], 90)
+
+    assert len(rotated) == 2
+    np.testing.assert_array_equal(rotated[0], np.rot90(band))
+    np.testing.assert_array_equal(rotated[1], np.rot90(band * 2))
+    assert rotated[0].dtype == np.uint8
+
+    # Same sampling as PIL for any number of bands, like 5 bands plus mask.
+    rng = np.random.default_rng(0)
+    for dtype in [np.uint8, np.float32]:
+        bands = [(rng.random((61, 47)) * 200).astype(dtype) for _ in range(6)]
+        for n_bands in [1, 2, 3, 5, 6]:
+            rotated = get_plot_bands.rotate_bands(bands[:n_bands], 17.3)
+            assert len(rotated) == n_bands
+            for band, rot in zip(bands, rotated):
+                expected = Image.fromarray(band).rotate(17.3, expand=True)
+                np.testing.assert_array_equal(rot, np.array(expected))
+                assert rot.dtype == dtype
+
+    return
+
+
+def test_extract_raster_data_grid_fit():
+    arrays, bands, df = get_plot_bands.extract_raster_data(
+        "add_on/flights/20180815_Lamberton_clipped.tif",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+    )
+    arrays_grid, bands_grid, df_grid = get_plot_bands.extract_raster_data(
+        "add_on/flights/20180815_Lamberton_clipped.tif",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+        fit="grid",
+    )
+
+    assert bands_grid == bands
+    assert df_grid.shape == df.shape
+    for p in arrays.keys():
+        h, w = arrays[p]["band_1"].shape
+        h_grid, w_grid = arrays_grid[p]["band_1"].shape
+        assert abs(h - h_grid) <= 2
+        assert abs(w - w_grid) <= 2
+    np.testing.assert_allclose(df_grid["band_1"], df["band_1"], atol=2)
+
+    return
+
+
+def test_geometry_fit_params():
+    transform = Affine(1, 0, 0, 0, -1, 40)
+
+    cpv, angle = get_plot_bands.geometry_fit_params(
+        box(0, 0, 10, 40), transform, (40, 10)
+    )
+    assert angle == 0
+    assert cpv == (2, 38, 2, 8)
+
+    cpv, angle = get_plot_bands.geometry_fit_params(
+        box(0, 30, 40, 40), transform, (10, 40), hbuffer=1, wbuffer=3
+    )
+    assert angle in (90, -90)
+    assert cpv == (1, 39, 3, 7)
+
+    return
+
+
+def test_extract_raster_data_geometry_fit():
+    arrays, bands, df = get_plot_bands.extract_raster_data(
+        "add_on/flights/20180815_Lamberton_clipped.tif",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+    )
+    arrays_geo, bands_geo, df_geo = get_plot_bands.extract_raster_data(
+        "add_on/flights/20180815_Lamberton_clipped.tif",
+        "add_on/Grids/Labmert_test_grid.geojson",
+        "fid",
+        fit="geometry",
+    )
+
+    assert bands_geo == bands
+    assert df_geo.shape == df.shape
+    for p in arrays.keys():
+        h, w = arrays[p]["band_1"].shape
+        h_geo, w_geo = arrays_geo[p]["band_1"].shape
+        assert abs(h - h_geo) <= 2
+        assert abs(w - w_geo) <= 2
+        # The buffers keep the nodata borders out of the crop.
+        assert np.all(arrays_geo[p]["band_1"] > 0)
+    np.testing.assert_allclose(df_geo["band_1"], df["band_1"], atol=2)
+
+    return
+
+
+def test_proces_stack_tiff_out_path():
+    out_path = "add_on/zarr_data/stream_group"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt_disk = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        out_path=out_path,
+    )
+
+    assert isinstance(pyt_disk.raw_data.store, zarr.DirectoryStore)
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(pyt_disk.ldata), pd.DataFrame(pyt.ldata)
+    )
+
+    pyt_disk.save(out_path)
+    pyt1 = get_plot_bands.read_zarr(out_path)
+    assert pyt1.dates == pyt.dates
+    for d in pyt.dates:
+        assert list(pyt1.raw_data["dates"][d].group_keys()) == list(
+            pyt.raw_data["dates"][d].group_keys()
+        )
+        for p in pyt.raw_data["dates"][d].group_keys():
+            np.testing.assert_array_equal(
+                pyt1.raw_data["dates"][d][p]["green"][:],
+                pyt.raw_data["dates"][d][p]["green"][:],
+            )
+
+    shutil.rmtree(out_path)
+
+    return
+
+
+def test_proces_stack_tiff_ragged_layout():
+    out_path = "add_on/zarr_data/ragged_group"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt_ragged = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        layout="ragged",
+    )
+    pyt_disk = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+        out_path=out_path,
+        layout="ragged",
+    )
+
+    date_group = pyt_ragged.raw_data["dates"][pyt.dates[0]]
+    assert date_group.attrs["layout"] == "ragged"
+    assert list(date_group.group_keys()) == []
+    assert date_group["index"].shape == (4, 3)
+    assert date_group["red"].ndim == 1
+
+    for d in pyt.dates:
+        assert sorted(pyt_ragged.plot_ids(d)) == pyt.plot_ids(d)
+        assert pyt_disk.plot_ids(d) == pyt_ragged.plot_ids(d)
+        for p in pyt.plot_ids(d):
+            arrays = pyt.plot_arrays(d, p)
+            for proj in (pyt_ragged, pyt_disk):
+                arrays_ragged = proj.plot_arrays(d, p)
+                assert list(arrays_ragged.keys()) == ["red", "green", "blue"]
+                for b in arrays.keys():
+                    np.testing.assert_array_equal(arrays_ragged[b], arrays[b])
+
+    shutil.rmtree(out_path)
+
+    return
+
+
+def test_read_zarr_consolidated():
+    out_path = "add_on/zarr_data/consolidated_group"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt.save(out_path)
+    assert os.path.isfile(out_path + "/raw_data/.zmetadata")
+
+    pyt1 = get_plot_bands.read_zarr(out_path)
+    assert isinstance(
+        pyt1.raw_data.store, zarr.storage.ConsolidatedMetadataStore
+    )
+    assert pyt1.plot_ids("20180815") == ["A1", "A2", "A3", "A4"]
+    np.testing.assert_array_equal(
+        pyt1.plot_arrays("20180815", "A2")["blue"],
+        pyt.plot_arrays("20180815", "A2")["blue"],
+    )
+
+    pyt2 = get_plot_bands.read_zarr(out_path, consolidated=False)
+    assert isinstance(pyt2.raw_data.store, zarr.DirectoryStore)
+    assert pyt2.plot_ids("20180815") == ["A1", "A2", "A3", "A4"]
+
+    shutil.rmtree(out_path)
+
+    return
+
+
+def test_read_zarr_parquet():
+    out_path = "add_on/zarr_data/parquet_group"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt.ldata["band_1_2_0.785_homog"] = np.arange(len(pyt.ldata))
+    pyt.save(out_path, ldata_format="parquet")
+    assert os.path.isfile(out_path + "/ldata.parquet")
+    assert not os.path.isfile(out_path + "/ldata.shp")
+
+    pyt1 = get_plot_bands.read_zarr(out_path)
+    assert "band_1_2_0.785_homog" in pyt1.ldata.columns
+    assert len(pyt1.ldata) == len(pyt.ldata)
+
+    pyt2 = get_plot_bands.read_zarr(
+        out_path,
+        columns=["id", "date", "band_1_2_0.785_homog"],
+        filters=[("date", "==", "20180815")],
+    )
+    assert list(pyt2.ldata.columns) == [
+        "id",
+        "date",
+        "band_1_2_0.785_homog",
+        "geometry",
+    ]
+    assert set(pyt2.ldata["date"]) == {"20180815"}
+    assert len(pyt2.ldata) == 4
+
+    shutil.rmtree(out_path)
+
+    pyt.save(out_path)
+    pyt3 = get_plot_bands.read_zarr(
+        out_path,
+        columns=["id", "date"],
+        filters=[("id", "in", ["A1", "A2"])],
+    )
+    assert set(pyt3.ldata["id"]) == {"A1", "A2"}
+    assert list(pyt3.ldata.columns) == ["id", "date", "geometry"]
+
+    shutil.rmtree(out_path)
+
+    return
+
+
+def test_read_zarr_lazy():
+    out_path = "add_on/zarr_data/lazy_group"
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+
+    pyt = get_plot_bands.process_stack_tiff(
+        "add_on/flights",
+        "add_on/Grids/Labmert_test_small.geojson",
+        "fid",
+        ["red", "green", "blue"],
+    )
+    pyt.save(out_path)
+
+    pyt1 = get_plot_bands.read_zarr(
+        out_path,
+        lazy=True,
+        columns=["id", "date"],
+        dates=["20180815", "20180829"],
+        ids=["A2"],
+    )
+    assert pyt1._ldata is None
+    assert pyt1._raw_data is None
+    assert pyt1.dates == ["20180815", "20180829"]
+    assert pyt1.n_dates == 2
+
+    assert list(pyt1.ldata.columns) == ["id", "date", "geometry"]
+    assert set(pyt1.ldata["id"]) == {"A2"}
+    assert set(pyt1.ldata["date"]) == {"20180815", "20180829"}
+    assert pyt1._raw_data is None
+
+    assert pyt1.plot_ids("20180815") == ["A2"]
+    np.testing.assert_array_equal(
+        pyt1.plot_arrays("20180815", "A2")["red"],
+        pyt.plot_arrays("20180815", "A2")["red"],
+    )
+
+    with pytest.raises(ValueError):
+        pyt1.save(out_path)
+    with pytest.raises(ValueError):
+        get_plot_bands.read_zarr(out_path, dates=["20000101"])
+
+    shutil.rmtree(out_path)
+
+    return
+
+
+def test_save_selection():
+    out_path = "add_on/zarr_data/selection_group"
+    sub_path = "add_on/zarr_data/selection_sub"
+    for path in [out_path, sub_path]:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    for layout in ["groups", "ragged"]:
+        pyt = get_plot_bands.process_stack_tiff(
+            "add_on/flights",
+            "add_on/Grids/Labmert_test_small.geojson",
+            "fid",
+            ["red", "green", "blue"],
+            layout=layout,
+        )
+        pyt.save(out_path)
+
+        # Only the selected dates and plots are saved.
+        pyt1 = get_plot_bands.read_zarr(
+            out_path, dates=["20180815"], ids=["A2", "A4"]
+        )
+        pyt1.save(sub_path)
+        pyt2 = get_plot_bands.read_zarr(sub_path)
+        assert pyt2.dates == ["20180815"]
+        assert list(pyt2.raw_data["dates"].group_keys()) == ["20180815"]
+        assert pyt2.plot_ids("20180815") == ["A2", "A4"]
+        assert set(pyt2.ldata["id"]) == {"A2", "A4"}
+        for plot in ["A2", "A4"]:
+            np.testing.assert_array_equal(
+                pyt2.plot_arrays("20180815", plot)["red"],
+                pyt.plot_arrays("20180815", plot)["red"],
+            )
+
+        shutil.rmtree(out_path)
+        shutil.rmtree(sub_path)
+
+    return
+
+
 # def test_read_zarr():
 
 #    dirlist = os.listdir('add_on/zarr_data')